@@ -1,19 +1,25 @@
 import streamlit as st
 import os
 from dotenv import load_dotenv
-import asyncio
-import aiohttp
-import re
+import concurrent.futures
+import uuid
 import json
+import latex_delimiters
+import metrics
+import model_router
+import openrouter_client
+import pricing_engine
+import prompt_engine
+import prompt_caching
+import catalog_refresher
+import response_cache
+import token_estimator
+import transcript
+import usage_ledger
 
 # Load environment variables
 load_dotenv()
 
-def replace_custom_latex_delimiters(text):
-    text = re.sub(r'\\\((.*?)\\\)', r'$\1$', text)
-    text = re.sub(r'\\\[(.*?)\\\]', r'$$\1$$', text, flags=re.DOTALL)
-    return text
-
 SPECIFIED_MODELS = [
     "openai/gpt-4o-mini",  # Default model
     "openai/gpt-4o",
@@ -39,26 +45,6 @@ def get_model_pricing(model_info):
     completion_price = float(pricing.get('completion', 0)) * 1000  # Convert to price per 1000 tokens
     return prompt_price, completion_price
 
-async def fetch_models_data_async(api_key):
-    url = "https://openrouter.ai/api/v1/models"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "http://localhost:8000",  # Replace with your actual URL
-        "X-Title": "Streamlit OpenRouter App",
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                st.error(f"Failed to fetch models data: {response.status}")
-                return None
-
-@st.cache_data(ttl=3600)  # Cache the result for 1 hour
-def get_models_data(api_key):
-    return asyncio.run(fetch_models_data_async(api_key))
-
 st.set_page_config(page_title="Prompt Editor", page_icon="📝", layout="wide")
 
 with st.sidebar:
@@ -73,33 +59,26 @@ if not api_key:
     st.warning("Please enter your OPENROUTER API key in the sidebar or set it in your .env file.", icon="⚠️")
     st.stop()
 
-# Use the function to get models data
-models_data = get_models_data(api_key)
+# Tag this browser session's requests in the usage ledger
+if "ledger_session" not in st.session_state:
+    st.session_state.ledger_session = uuid.uuid4().hex[:12]
+usage_ledger.set_context(session=st.session_state.ledger_session)
 
-if models_data:
-    # Create a dictionary for quick model lookup
-    models_dict = {model['id']: model for model in models_data['data']}
-    
-    # Create a list of all model names from the API
-    all_model_options = [model['id'] for model in models_data['data']]
-    
-    # Create the final model_options list
-    model_options = []
-    
-    # Add specified models that exist in the API data
-    for model in SPECIFIED_MODELS:
-        if model in all_model_options:
-            model_options.append(model)
-    
-    # Add remaining models from the API data
-    for model in all_model_options:
-        if model not in SPECIFIED_MODELS:
-            model_options.append(model)
-    
-    # Add the custom option at the end
+# Get the compiled models catalog, shared across sessions and refreshed in the background
+catalog = catalog_refresher.get_catalog(api_key)
+if catalog_refresher.is_fallback(catalog):
+    st.caption(f"Using the bundled models.json catalog. {catalog_refresher.last_error or ''}")
+
+if catalog:
+    # Pricing in the catalog is already parsed to floats
+    models_dict = catalog.models
+    model_options = catalog.options(SPECIFIED_MODELS)
+    usage_ledger.use_catalog(catalog)
+    pricing = pricing_engine.for_catalog(catalog)
     model_options.append("Custom (type your own)")
 else:
     models_dict = {}
+    pricing = pricing_engine.for_catalog(None)
     model_options = ["Custom (type your own)"]
 
 with st.sidebar:
@@ -126,84 +105,169 @@ with st.sidebar:
         st.write(model_description)
     
     temperature = st.slider("Temperature", min_value=0.0, max_value=2.0, value=1.0, step=0.1)
+    
+    # Reuse responses for identical requests instead of calling the API again
+    cache_responses = st.toggle("Reuse cached responses", value=True)
+    cache_sampled = st.toggle("Also cache sampled responses (temperature > 0)", value=False, disabled=not cache_responses)
+    cache_mode = response_cache.mode_for(cache_responses, cache_sampled)
+    
+    # Send the prompt to several models at once and compare them side by side
+    compare_mode = st.toggle("Compare models", value=False)
+    if compare_mode:
+        compare_models = st.multiselect(
+            "Models to compare",
+            [option for option in model_options if option != "Custom (type your own)"],
+            default=[model for model in SPECIFIED_MODELS[:4] if model in models_dict],
+        )
+    
+    # Pick the model per prompt from a pool, by recent speed, errors and price,
+    # failing over to the next one when a model errors
+    adaptive_routing = st.toggle("Adaptive routing", value=False, disabled=compare_mode)
+    model_pool = []
+    if adaptive_routing and not compare_mode:
+        model_pool = st.multiselect(
+            "Model pool",
+            [option for option in model_options if option != "Custom (type your own)"],
+            default=[model for model in model_router.similar_models(catalog, model_name) if model in models_dict],
+        )
+        with st.expander("Routing table"):
+            st.dataframe(model_router.scores(model_pool, catalog), hide_index=True)
 
 # Display only the model name as the main title
 st.markdown(f"# `{model_name}`")
 
-# Replace the part where you load models data from the file
-async def call_openrouter_api(session, system_prompt, prompt, model, temperature, api_key):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "http://localhost:8000",  # Replace with your actual URL
-        "X-Title": "Streamlit OpenRouter App",
-    }
-    
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": prompt})
-    
-    payload = {
+def get_responses(system_prompt, prompt, num_responses):
+    # Returns (model, responses); with a model pool the model is picked per prompt
+    api_key = openrouter_api_key if openrouter_api_key else os.environ.get("OPENROUTER_API_KEY")
+    if model_pool:
+        return openrouter_client.run(prompt_engine.get_routed_responses_async(
+            system_prompt, prompt, num_responses, model_router.rank(model_pool, catalog), temperature, api_key, cache_mode))
+    return model_name, openrouter_client.run(prompt_engine.get_responses_async(system_prompt, prompt, num_responses, model_name, temperature, api_key, cache_mode))
+
+# Models shown per row in the comparison grid
+COMPARE_COLUMNS = 3
+
+async def compare_one(system_prompt, prompt, model, temperature, api_key):
+    messages = prompt_engine.build_messages(system_prompt, prompt)
+    return model, await openrouter_client.stream_openrouter_api_async(messages, model, api_key, temperature)
+
+def comparison_row(model, result):
+    cost = None
+    if result.usage:
+        prompt_cost, completion_cost = pricing.cost(result.usage, model)
+        if prompt_cost is not None and completion_cost is not None:
+            cost = prompt_cost + completion_cost
+    content = result.content or result.error or ""
+    return {
         "model": model,
-        "messages": messages,
-        "temperature": temperature
+        "content": latex_delimiters.convert(content),
+        "error": result.error,
+        "latency": result.elapsed,
+        "ttft": result.ttft,
+        "tokens_per_second": result.tokens_per_second,
+        "tokens": (result.usage or {}).get('completion_tokens'),
+        "cost": cost,
     }
-    
-    async with session.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload) as response:
-        if response.status == 200:
-            data = await response.json()
-            content = data['choices'][0]['message']['content']
-            usage = data.get('usage', {})
-            return content, usage
-        else:
-            return f"Error: {response.status}", None
-
-def calculate_cost(usage, model_id):
-    model = models_dict.get(model_id)
-    if not model:
-        return None, None
 
-    prompt_tokens = usage['prompt_tokens']
-    completion_tokens = usage['completion_tokens']
-    
-    prompt_cost = float(model['pricing']['prompt']) * prompt_tokens
-    completion_cost = float(model['pricing']['completion']) * completion_tokens
-    
-    return prompt_cost, completion_cost
+def render_comparison_row(row):
+    st.markdown(f"#### `{row['model']}`")
+    stats = []
+    if row['latency'] is not None:
+        stats.append(f"**Latency**: {row['latency']:.2f}s")
+    if row['ttft'] is not None:
+        stats.append(f"**TTFT**: {row['ttft']:.2f}s")
+    if row['tokens_per_second'] is not None:
+        stats.append(f"**Speed**: {row['tokens_per_second']:.1f} tok/s")
+    if row['cost'] is not None:
+        stats.append(f"**Cost**: ${row['cost']:.6f}")
+    st.caption(", ".join(stats))
+    if row['error'] and not row['content']:
+        st.error(row['error'])
+    else:
+        st.markdown(row['content'])
 
-async def get_responses_async(system_prompt, prompt, num_responses, model, temperature, api_key):
-    async with aiohttp.ClientSession() as session:
-        tasks = [call_openrouter_api(session, system_prompt, prompt, model, temperature, api_key) for _ in range(num_responses)]
-        results = await asyncio.gather(*tasks)
-    return [(replace_custom_latex_delimiters(content), usage) for content, usage in results]
+def comparison_placeholders(models):
+    placeholders = {}
+    for start in range(0, len(models), COMPARE_COLUMNS):
+        for model, column in zip(models[start:start + COMPARE_COLUMNS], st.columns(COMPARE_COLUMNS)):
+            placeholders[model] = column.empty()
+    return placeholders
 
-def get_responses(system_prompt, prompt, num_responses):
+def run_comparison(system_prompt, prompt, models):
+    # All models stream concurrently on the client loop; each column is
+    # filled in as soon as its model finishes
     api_key = openrouter_api_key if openrouter_api_key else os.environ.get("OPENROUTER_API_KEY")
-    return asyncio.run(get_responses_async(system_prompt, prompt, num_responses, model_name, temperature, api_key))
+    placeholders = comparison_placeholders(models)
+    for model in models:
+        placeholders[model].info(f"Waiting for `{model}`...")
+    futures = [openrouter_client.submit(compare_one(system_prompt, prompt, model, temperature, api_key)) for model in models]
+    rows = {}
+    for future in concurrent.futures.as_completed(futures):
+        model, result = future.result()
+        rows[model] = comparison_row(model, result)
+        with placeholders[model].container():
+            render_comparison_row(rows[model])
+    return [rows[model] for model in models]
 
-if "responses" not in st.session_state:
-    st.session_state.responses = []
+# The last run's responses live in the conversation store rather than in server
+# memory, and ?conversation=<id> brings them back after a reload or restart
+run_store = transcript.current_conversation("app")
 if "prompt" not in st.session_state:
+    saved_run = run_store.load_state()
+    st.session_state.prompt = saved_run.get("prompt", "")
+    st.session_state.system_prompt = saved_run.get("system_prompt", "")
+
+def save_run(responses=(), comparison=(), model=None):
+    run_store.save_state({
+        "prompt": st.session_state.prompt,
+        "system_prompt": st.session_state.system_prompt,
+        "model": model,
+        "routed": bool(model_pool),
+        "responses": list(responses),
+        "comparison": list(comparison),
+    }, title=st.session_state.prompt)
+
+def reset_prompt():
     st.session_state.prompt = ""
-if "system_prompt" not in st.session_state:
     st.session_state.system_prompt = ""
+    transcript.switch_conversation("app")
+    # Drop the widget state so the text areas come back empty
+    st.session_state.pop("prompt_input", None)
+    st.session_state.pop("system_prompt_input", None)
 
+# Not a form, so edits rerun the script and the sidebar estimate stays current
 st.markdown("### Prompt")
-with st.form("prompt_form"):
+with st.container(border=True):
     system_prompt = st.text_area("System Prompt (optional):", value=st.session_state.system_prompt, height=50, key="system_prompt_input")
     prompt = st.text_area("User Prompt:", value=st.session_state.prompt, height=200, key="prompt_input")
     num_responses = st.radio("Select number of responses", options=[1, 2, 3, 4], index=0, horizontal=True)
     col1, col2, col3 = st.columns([1, 1, 4])
     with col1:
-        submitted = st.form_submit_button("Submit")
+        submitted = st.button("Submit")
     with col2:
-        reset = st.form_submit_button("Reset")
+        st.button("Reset", on_click=reset_prompt)
 
-if reset:
-    st.session_state.prompt = ""
-    st.session_state.system_prompt = ""
-    st.session_state.responses = []
-    st.rerun()
+# Estimate prompt size and cost locally before anything is sent
+with st.sidebar:
+    if model_name and (system_prompt or prompt):
+        estimate = token_estimator.estimate_request(prompt_engine.build_messages(system_prompt, prompt), model_name, models_dict.get(model_name))
+        st.markdown("### Estimate")
+        if estimate['prompt_cost'] is not None:
+            # The n path bills the prompt once; fanned-out requests each pay for it
+            prompt_bills = 1 if openrouter_client.supports_n(model_name) else num_responses
+            st.markdown(f"**Prompt**: ~{estimate['prompt_tokens']:,} tokens, ~${estimate['prompt_cost'] * prompt_bills:.6f}")
+        else:
+            st.markdown(f"**Prompt**: ~{estimate['prompt_tokens']:,} tokens")
+        if estimate['context_fill'] is not None:
+            st.progress(min(estimate['context_fill'], 1.0), text=f"Context window: {estimate['context_fill']:.1%} of {estimate['context_length']:,} tokens")
+
+    # Latency and throughput of the requests this server process has made
+    with st.expander("Request metrics"):
+        metric_rows = metrics.summary()
+        if metric_rows:
+            st.dataframe(metric_rows, hide_index=True)
+        else:
+            st.caption("No requests yet.")
 
 if submitted:
     if not openrouter_api_key and not os.environ.get("OPENROUTER_API_KEY"):
@@ -211,23 +275,63 @@ if submitted:
     elif prompt.strip() != "":
         st.session_state.prompt = prompt
         st.session_state.system_prompt = system_prompt
-        with st.spinner("Generating responses..."):
-            st.session_state.responses = get_responses(system_prompt, prompt, num_responses)
+        if compare_mode:
+            if compare_models:
+                st.markdown("### Responses:")
+                save_run(comparison=run_comparison(system_prompt, prompt, compare_models))
+            else:
+                st.warning("Select at least one model to compare.")
+        else:
+            with st.spinner("Generating responses..."):
+                response_model, responses = get_responses(system_prompt, prompt, num_responses)
+                save_run(responses=responses, model=response_model)
         st.rerun()
 
 st.markdown("### Responses:")
-if st.session_state.responses:
-    tabs = st.tabs([f"Response {i+1}" for i in range(len(st.session_state.responses))])
-    for i, (tab, (response, usage)) in enumerate(zip(tabs, st.session_state.responses)):
+saved_run = run_store.load_state()
+if saved_run.get("comparison"):
+    rows = saved_run["comparison"]
+    placeholders = comparison_placeholders([row['model'] for row in rows])
+    for row in rows:
+        with placeholders[row['model']].container():
+            render_comparison_row(row)
+    st.markdown("#### Summary")
+    st.dataframe(
+        [
+            {
+                "Model": row['model'],
+                "Latency (s)": row['latency'],
+                "TTFT (s)": row['ttft'],
+                "Tokens/s": row['tokens_per_second'],
+                "Completion tokens": row['tokens'],
+                "Cost ($)": row['cost'],
+                "Error": row['error'],
+            }
+            for row in rows
+        ],
+        hide_index=True,
+    )
+elif saved_run.get("responses"):
+    response_model = saved_run.get("model") or model_name
+    if saved_run.get("routed"):
+        st.caption(f"**Routed to**: `{response_model}`")
+    tabs = st.tabs([f"Response {i+1}" for i in range(len(saved_run["responses"]))])
+    for i, (tab, (response, usage)) in enumerate(zip(tabs, saved_run["responses"])):
         with tab:
             st.markdown(response)
             if usage:
-                prompt_cost, completion_cost = calculate_cost(usage, model_name)
+                prompt_cost, completion_cost = pricing.cost(usage, response_model)
                 if prompt_cost is not None and completion_cost is not None:
                     total_cost = prompt_cost + completion_cost
                     total_tokens = usage['prompt_tokens'] + usage['completion_tokens']
                     st.markdown(f"**Cost**: ${total_cost:.6f}, **Tokens**: {total_tokens}")
+                    if prompt_caching.cached_tokens(usage):
+                        st.caption(f"{prompt_caching.cached_tokens(usage)} prompt tokens were read from the provider's prompt cache at the discounted rate.")
+                    if usage.get('shared_choices'):
+                        st.caption(f"Generated in one request with {usage['shared_choices']} choices; prompt cost is split evenly between them.")
+                    if usage.get('response_cache_hit'):
+                        st.caption("Served from the response cache; this request was not billed again.")
                 else:
-                    st.markdown(f"Error: Model {model_name} not found in models.json")
+                    st.markdown(f"Error: Model {response_model} not found in models.json")
             else:
                 st.markdown("Usage information not available")
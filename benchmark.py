@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# The client modules read these at import time. Benchmarks shouldn't grow the
+# metrics log or usage ledger
+os.environ.setdefault("OPENROUTER_METRICS_LOG", "")
+os.environ.setdefault("USAGE_LEDGER_PATH", "")
+
+import mock_openrouter
+import openrouter_client
+import rate_limiter
+import response_cache
+
+API_KEY = "mock-key"
+PROMPT = "Explain the difference between latency and throughput in two paragraphs."
+N_MODEL = "openai/gpt-4o-mini"  # Honours `n` on the mock, like on OpenRouter
+FANOUT_MODEL = "anthropic/claude-3-haiku"  # Ignores `n`, so responses are fanned out
+FANOUT_RESPONSES = 4
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _bounded(count, concurrency, request):
+    # Runs request(i) count times with at most concurrency in flight; returns
+    # [(latency, ok, ttft)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            ok, ttft = await request(i)
+            return time.perf_counter() - started, ok, ttft
+
+    return await asyncio.gather(*[one(i) for i in range(count)])
+
+
+def scenario_chat(count, concurrency):
+    # Single completions through the pooled async path (prompt editor, cost calculator)
+    async def request(i):
+        content, usage = await openrouter_client.call_openrouter_api_async(
+            [{"role": "user", "content": f"{PROMPT} #{i}"}], N_MODEL, API_KEY)
+        return usage is not None, None
+
+    return openrouter_client.run(_bounded(count, concurrency, request)), count
+
+
+def scenario_choices(count, concurrency):
+    # One request for several responses, as get_responses_async does for n-capable models
+    async def request(i):
+        contents, usage = await openrouter_client.call_openrouter_api_choices_async(
+            [{"role": "user", "content": f"{PROMPT} #{i}"}], N_MODEL, API_KEY, FANOUT_RESPONSES, temperature=1.0)
+        return usage is not None and len(contents) == FANOUT_RESPONSES, None
+
+    return openrouter_client.run(_bounded(count, concurrency, request)), count
+
+
+def scenario_fanout(count, concurrency):
+    # Several requests per prompt, as get_responses_async does when `n` isn't honoured
+    async def request(i):
+        messages = [{"role": "user", "content": f"{PROMPT} #{i}"}]
+        results = await asyncio.gather(*[
+            openrouter_client.call_openrouter_api_async(messages, FANOUT_MODEL, API_KEY, 1.0, cache_variant=variant)
+            for variant in range(FANOUT_RESPONSES)
+        ])
+        return all(usage is not None for _, usage in results), None
+
+    return openrouter_client.run(_bounded(count, concurrency, request)), count * FANOUT_RESPONSES
+
+
+def scenario_stream(count, concurrency):
+    # Background streams polled from worker threads, like concurrent chat_app sessions
+    def request(i):
+        started = time.perf_counter()
+        stream = openrouter_client.start_stream([{"role": "user", "content": f"{PROMPT} #{i}"}], N_MODEL, API_KEY)
+        stream.finished.wait()
+        return time.perf_counter() - started, stream.error is None, stream.ttft
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(request, range(count))), count
+
+
+def scenario_batch(count, concurrency):
+    # The cost calculator's --batch mode end to end, including the output file
+    import openrouter_cost_calculator
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, "prompts.jsonl")
+        output_path = os.path.join(directory, "results.jsonl")
+        with open(input_path, 'w') as f:
+            for i in range(count):
+                f.write(json.dumps({"id": i, "prompt": f"{PROMPT} #{i}", "model": N_MODEL}) + "\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, totals = openrouter_client.run(openrouter_cost_calculator.run_batch_async(
+                input_path, output_path, API_KEY, concurrency, response_cache.CACHE_OFF))
+    # Rows aren't timed individually, so this scenario only reports throughput
+    return [(None, True, None)] * (totals["rows"] - totals["errors"]) + [(None, False, None)] * totals["errors"], count
+
+
+def scenario_models(count, concurrency):
+    # Catalog downloads from /models (what the catalog refresher does on a cold start)
+    def request(i):
+        started = time.perf_counter()
+        data, error = openrouter_client.fetch_models_data(API_KEY)
+        return time.perf_counter() - started, error is None, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(request, range(count))), count
+
+
+SCENARIOS = {
+    "chat": scenario_chat,
+    "choices": scenario_choices,
+    "fanout": scenario_fanout,
+    "stream": scenario_stream,
+    "batch": scenario_batch,
+    "models": scenario_models,
+}
+
+
+def run_scenario(name, count, concurrency, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    results, requests_sent = SCENARIOS[name](count, concurrency)
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, ok, _ in results if ok and latency is not None]
+    ttfts = [ttft for _, ok, ttft in results if ok and ttft is not None]
+    report = {
+        "scenario": name,
+        "count": count,
+        "concurrency": concurrency,
+        "requests": requests_sent,
+        "errors": sum(1 for _, ok, _ in results if not ok),
+        "elapsed": elapsed,
+        "requests_per_second": requests_sent / elapsed if elapsed else None,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "ttft_p50": percentile(ttfts, 0.5),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if trace_memory:
+        report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return report
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:8.1f}" if seconds is not None else "       -"
+
+
+def print_report(report):
+    line = (f"{report['scenario']:<8} {report['requests']:>6} req {report['errors']:>4} err "
+            f"{report['requests_per_second']:8.1f} req/s  p50 {_ms(report['p50'])} ms  p90 {_ms(report['p90'])} ms  "
+            f"p99 {_ms(report['p99'])} ms  ttft {_ms(report['ttft_p50'])} ms  rss {report['max_rss_mb']:.0f} MB")
+    if "peak_traced_mb" in report:
+        line += f"  traced {report['peak_traced_mb']:.1f} MB"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OpenRouter client against a local mock server")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--count", type=int, default=200, help="Prompts per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Prompts in flight at once")
+    parser.add_argument("--latency", type=float, default=0.2, help="Median mock seconds to the first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Mock generation speed (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of mock responses that are 429s")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with mock 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock responses that are 502s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the mock's latency and error draws")
+    parser.add_argument("--replay", metavar="JSONL", help="Serve responses recorded with mock_openrouter.py --record")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report peak Python allocations (slower)")
+    parser.add_argument("--json", metavar="PATH", help="Append the reports as JSON lines, e.g. to compare commits")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    reports = []
+    for name in args.scenarios or SCENARIOS:
+        # A fresh server per scenario so each one sees the same seeded draws
+        config = mock_openrouter.MockConfig(args.latency, args.latency_sigma, args.tokens_per_second, args.completion_tokens,
+                                            args.rate_limit_rate, args.retry_after, args.error_rate, args.seed)
+        server = mock_openrouter.MockServer(mock_openrouter.create_app(config, replay_path=args.replay)).start()
+        openrouter_client.OPENROUTER_BASE_URL = server.base_url
+        rate_limiter.scheduler = rate_limiter.Scheduler()
+        try:
+            report = run_scenario(name, args.count, args.concurrency, args.trace_memory)
+        finally:
+            server.stop()
+        report["server"] = dict(server.stats)
+        reports.append(report)
+        print_report(report)
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            for report in reports:
+                f.write(json.dumps(dict(report, time=time.time(), seed=args.seed)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+
+import model_catalog
+import openrouter_client
+
+# Refresh settings (override with environment variables)
+META_PATH = os.getenv("MODELS_META_PATH", ".models_catalog_meta.json")
+LOCK_PATH = f"{META_PATH}.lock"
+TTL = float(os.getenv("MODELS_TTL", "3600"))  # Seconds a fetched catalog counts as fresh
+REFRESH_AHEAD = float(os.getenv("MODELS_REFRESH_AHEAD", "0.8"))  # Revalidate once this fraction of TTL has passed
+RETRY_AFTER = float(os.getenv("MODELS_RETRY_AFTER", "60"))  # Seconds between attempts after a failed fetch
+LOCK_TIMEOUT = 60  # Seconds after which another process's refresh lock is considered abandoned
+
+# The catalog is shared by every session in this process; the metadata file and
+# the fetched index (model_catalog.FETCHED_INDEX_PATH) are shared by every process
+_lock = threading.Lock()
+_catalog = None
+_refreshing = False
+last_error = None
+
+
+def _read_meta():
+    try:
+        with open(META_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(meta):
+    tmp_path = f"{META_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, META_PATH)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _acquire_process_lock():
+    # Only one process revalidates at a time; the rest keep serving what they have
+    try:
+        fd = os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(LOCK_PATH) < LOCK_TIMEOUT:
+                return False
+            os.remove(LOCK_PATH)
+            fd = os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def _release_process_lock():
+    try:
+        os.remove(LOCK_PATH)
+    except OSError:
+        pass
+
+
+def refresh(api_key=None):
+    # Conditional fetch of /models. Returns True if the shared catalog is current
+    global last_error
+    if not _acquire_process_lock():
+        return False
+    try:
+        meta = _read_meta()
+        status, models_data, validators = openrouter_client.fetch_models_data_conditional(
+            api_key, meta.get("etag"), meta.get("last_modified"))
+        now = time.time()
+        if status == 304 and meta.get("source"):
+            meta["fetched_at"] = now
+        elif models_data is not None:
+            source = model_catalog.data_source(models_data)
+            if source != meta.get("source"):
+                # Only changed content is recompiled
+                model_catalog.catalog_from_data(models_data)
+            meta = {"source": source, "fetched_at": now, **validators}
+        else:
+            last_error = f"Failed to fetch models data: {status or 'network error'}"
+            meta["failed_at"] = now
+            _write_meta(meta)
+            return False
+        meta.pop("failed_at", None)
+        _write_meta(meta)
+        last_error = None
+        return True
+    finally:
+        _release_process_lock()
+
+
+def _refresh_in_background(api_key):
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    def worker():
+        global _refreshing
+        try:
+            refresh(api_key)
+        finally:
+            _refreshing = False
+
+    threading.Thread(target=worker, name="catalog-refresh", daemon=True).start()
+
+
+def _load_shared(meta):
+    # Catalog published by whichever process last refreshed
+    global _catalog
+    source = meta.get("source")
+    if source and (_catalog is None or _catalog.source != source):
+        catalog = model_catalog.read_catalog(source)
+        if catalog is not None:
+            _catalog = catalog
+    return _catalog
+
+
+def _retry_wait(meta):
+    # Seconds since the last failed fetch
+    return time.time() - meta.get("failed_at", 0)
+
+
+def get_catalog(api_key=None):
+    # Never blocks on the network once any catalog has been fetched: a stale
+    # catalog is served while a background refresh revalidates it
+    global _catalog
+    meta = _read_meta()
+    catalog = _load_shared(meta)
+    if catalog is None:
+        # Nothing fetched yet on this machine: fetch once, else use the bundled file
+        if refresh(api_key):
+            catalog = _load_shared(_read_meta())
+        if catalog is None:
+            _catalog = catalog = model_catalog.load_catalog_file()
+            # A failed fetch recorded failed_at, so it isn't retried right away
+            if _retry_wait(_read_meta()) >= RETRY_AFTER:
+                _refresh_in_background(api_key)
+        return catalog
+    age = time.time() - meta.get("fetched_at", 0)
+    if age >= TTL * REFRESH_AHEAD and _retry_wait(meta) >= RETRY_AFTER:
+        _refresh_in_background(api_key)
+    return catalog
+
+
+def is_fallback(catalog):
+    # True when the bundled models.json is being served instead of live data
+    return catalog is not None and catalog.source.startswith("file:")
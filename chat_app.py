@@ -1,17 +1,25 @@
 import streamlit as st
 import os
+import json
 from dotenv import load_dotenv
-import re
-import requests
+import uuid
+import time
+import latex_delimiters
+import metrics
+import model_router
+import openrouter_client
+import pricing_engine
+import prompt_caching
+import catalog_refresher
+import response_cache
+import token_estimator
+import transcript
+import usage_ledger
+import chat_history
 
 # Load environment variables
 load_dotenv()
 
-def replace_custom_latex_delimiters(text):
-    text = re.sub(r'\\\((.*?)\\\)', r'$\1$', text)
-    text = re.sub(r'\\\[(.*?)\\\]', r'$$\1$$', text, flags=re.DOTALL)
-    return text
-
 SPECIFIED_MODELS = [
     "openai/gpt-4o-mini",  # Default model
     "openai/gpt-4o",
@@ -35,22 +43,6 @@ def get_model_pricing(model_info):
     completion_price = float(pricing.get('completion', 0)) * 1000  # Convert to price per 1000 tokens
     return prompt_price, completion_price
 
-@st.cache_data(ttl=3600)  # Cache the result for 1 hour
-def get_models_data(api_key):
-    url = "https://openrouter.ai/api/v1/models"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "http://localhost:8000",  # Replace with your actual URL
-        "X-Title": "Streamlit OpenRouter App",
-    }
-    
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        st.error(f"Failed to fetch models data: {response.status_code}")
-        return None
-
 st.set_page_config(page_title="Chat with AI", page_icon="💬", layout="wide")
 
 with st.sidebar:
@@ -65,16 +57,26 @@ if not api_key:
     st.warning("Please enter your OPENROUTER API key in the sidebar or set it in your .env file.", icon="⚠️")
     st.stop()
 
-# Use the function to get models data
-models_data = get_models_data(api_key)
+# Tag this browser session's requests in the usage ledger
+if "ledger_session" not in st.session_state:
+    st.session_state.ledger_session = uuid.uuid4().hex[:12]
+usage_ledger.set_context(session=st.session_state.ledger_session)
+
+# Get the compiled models catalog, shared across sessions and refreshed in the background
+catalog = catalog_refresher.get_catalog(api_key)
+if catalog_refresher.is_fallback(catalog):
+    st.caption(f"Using the bundled models.json catalog. {catalog_refresher.last_error or ''}")
 
-if models_data:
-    models_dict = {model['id']: model for model in models_data['data']}
-    all_model_options = [model['id'] for model in models_data['data']]
-    model_options = [model for model in SPECIFIED_MODELS if model in all_model_options] + [model for model in all_model_options if model not in SPECIFIED_MODELS]
+if catalog:
+    # Pricing in the catalog is already parsed to floats
+    models_dict = catalog.models
+    model_options = catalog.options(SPECIFIED_MODELS)
+    usage_ledger.use_catalog(catalog)
+    pricing = pricing_engine.for_catalog(catalog)
     model_options.append("Custom (type your own)")
 else:
     models_dict = {}
+    pricing = pricing_engine.for_catalog(None)
     model_options = ["Custom (type your own)"]
 
 with st.sidebar:
@@ -88,6 +90,37 @@ with st.sidebar:
     # Temperature slider
     temperature = st.slider("Temperature", min_value=0.0, max_value=2.0, value=1.0, step=0.1)
     
+    # Reuse responses for identical requests instead of calling the API again
+    cache_responses = st.toggle("Reuse cached responses", value=True)
+    cache_sampled = st.toggle("Also cache sampled responses (temperature > 0)", value=False, disabled=not cache_responses)
+    cache_mode = response_cache.mode_for(cache_responses, cache_sampled)
+    
+    # Stream tokens into the chat as they are generated
+    stream_responses = st.toggle("Stream responses", value=True)
+    
+    # Pick the model per request from a pool, by recent speed, errors and price,
+    # failing over to the next one when a model errors or stalls
+    adaptive_routing = st.toggle("Adaptive routing", value=False)
+    model_pool = []
+    if adaptive_routing:
+        model_pool = st.multiselect(
+            "Model pool",
+            [option for option in model_options if option != "Custom (type your own)"],
+            default=[model for model in model_router.similar_models(catalog, model_name) if model in models_dict],
+        )
+        with st.expander("Routing table"):
+            st.dataframe(model_router.scores(model_pool, catalog), hide_index=True)
+    
+    # Limit how much history is resent on each turn
+    with st.expander("History"):
+        history_settings = {
+            "policy": st.selectbox("History policy", chat_history.POLICIES, index=0),
+            "budget_fraction": st.slider("Context budget (% of the model's window)", min_value=5, max_value=100, value=50, step=5) / 100,
+            "pin_first": st.number_input("Always keep first messages", min_value=0, max_value=10, value=1),
+            "pin_last": st.number_input("Always keep last messages", min_value=1, max_value=20, value=4),
+        }
+        summary_model = st.text_input("Summary model", value=chat_history.SUMMARY_MODEL)
+    
     if model_name in models_dict:
         prompt_price, completion_price = get_model_pricing(models_dict[model_name])
         st.markdown(f"""
@@ -109,57 +142,118 @@ system_prompt = st.text_area("System Prompt (optional):", height=30)
 # Add message display toggle
 display_mode = st.radio("Messages Display", ["Markdown", "Text"], horizontal=True)
 
-def call_openrouter_api(messages, model, temperature, api_key):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "http://localhost:8000",  # Replace with your actual URL
-        "X-Title": "Streamlit OpenRouter App",
-    }
-    
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature
-    }
-    
-    response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-    if response.status_code == 200:
-        data = response.json()
-        content = data['choices'][0]['message']['content']
-        usage = data.get('usage', {})
-        return content, usage
-    else:
-        return f"Error: {response.status_code}", None
+# Minimum seconds between placeholder updates while streaming
+STREAM_RENDER_INTERVAL = 0.05
 
-def calculate_cost(usage, model_id):
-    model = models_dict.get(model_id)
-    if not model:
-        return None, None
+# Chat history lives in the conversation store; only recent turns are kept in memory
+conversation = transcript.conversation_picker("chat_app")
 
-    prompt_tokens = usage['prompt_tokens']
-    completion_tokens = usage['completion_tokens']
-    
-    prompt_cost = float(model['pricing']['prompt']) * prompt_tokens
-    completion_cost = float(model['pricing']['completion']) * completion_tokens
-    
-    return prompt_cost, completion_cost
+def build_api_messages(summary=None):
+    if summary is None:
+        summary = conversation.load_state().get("summary")
+    return chat_history.build_context(system_prompt, conversation, model_name, models_dict.get(model_name),
+                                      history_settings, summary)
 
-# Initialize chat history
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+def next_turn_estimate():
+    # Recomputed only when the conversation, its summary or the settings change:
+    # with the full history policy, building the context reads the whole
+    # conversation from the store
+    summary = conversation.load_state().get("summary")
+    key = (conversation.id, len(conversation), system_prompt, model_name,
+           json.dumps([history_settings, summary], sort_keys=True))
+    cached = st.session_state.get("next_turn_estimate")
+    if cached is None or cached[0] != key:
+        context_messages, _ = build_api_messages(summary)
+        cached = (key, token_estimator.estimate_request(context_messages, model_name, models_dict.get(model_name)))
+        st.session_state.next_turn_estimate = cached
+    return cached[1]
 
-# Display chat messages from history on app rerun
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        if display_mode == "Markdown":
-            st.markdown(replace_custom_latex_delimiters(message["content"]))
+# Estimate what the next turn will resend (system prompt plus history) before sending it
+with st.sidebar:
+    if model_name:
+        estimate = next_turn_estimate()
+        st.markdown("### Next Turn Estimate")
+        if estimate['prompt_cost'] is not None:
+            st.markdown(f"**Context**: ~{estimate['prompt_tokens']:,} tokens, ~${estimate['prompt_cost']:.6f} before your message")
         else:
-            st.text(message["content"])
+            st.markdown(f"**Context**: ~{estimate['prompt_tokens']:,} tokens before your message")
+        if estimate['context_fill'] is not None:
+            st.progress(min(estimate['context_fill'], 1.0), text=f"Context window: {estimate['context_fill']:.1%} of {estimate['context_length']:,} tokens")
+
+    # Latency and throughput of the requests this server process has made
+    with st.expander("Request metrics"):
+        metric_rows = metrics.summary()
+        if metric_rows:
+            st.dataframe(metric_rows, hide_index=True)
+        else:
+            st.caption("No requests yet.")
+
+def stop_generation():
+    # Aborts the upstream request; the partial answer is kept
+    generation = st.session_state.get("generation")
+    if generation is not None:
+        generation["stream"].cancel()
+
+def save_answer(conversation):
+    # Appends the answer when the background task ends, so it is kept even if
+    # this session is closed or moves on before the next rerun
+    def on_finish(stream):
+        full_response = stream.content
+        if not full_response:
+            full_response = "(Stopped before any text was generated)" if stream.cancelled else stream.error or ""
+        conversation.append({"role": "assistant", "content": full_response})
+    return on_finish
+
+def finish_generation(generation):
+    # The answer itself was already saved by save_answer()
+    stream = generation["stream"]
+    st.session_state.last_turn = {
+        "model": stream.model,
+        "routed": generation["routed"],
+        "usage": stream.usage if stream.cancelled or not stream.error else None,
+        "stopped": stream.cancelled,
+        "ttft": stream.ttft,
+        "context_plan": generation["context_plan"],
+    }
+    del st.session_state.generation
 
-# Accept user input
-if prompt := st.chat_input("What is your message?"):
+def render_turn_info(turn):
+    usage = turn["usage"]
+    if turn["routed"] and turn["model"]:
+        st.caption(f"**Routed to**: `{turn['model']}`")
+    if turn["stopped"]:
+        st.caption("Stopped early; the tokens generated so far are still billed.")
+    if usage:
+        prompt_cost, completion_cost = pricing.cost(usage, turn["model"])
+        if prompt_cost is not None and completion_cost is not None:
+            total_cost = prompt_cost + completion_cost
+            total_tokens = usage['prompt_tokens'] + usage['completion_tokens']
+            estimated = "~" if usage.get('estimated') else ""
+            st.caption(f"**Cost**: {estimated}${total_cost:.6f}, **Tokens**: {estimated}{total_tokens}")
+            if prompt_caching.cached_tokens(usage):
+                st.caption(f"**Cached prompt tokens**: {prompt_caching.cached_tokens(usage)} (billed at the discounted cache rate)")
+            if usage.get('response_cache_hit'):
+                st.caption("Served from the response cache; this request was not billed again.")
+        else:
+            st.caption(f"Error: Model {turn['model']} not found in models.json")
+    else:
+        st.caption("Usage information not available")
+    if turn["ttft"] is not None:
+        st.caption(f"**Time to first token**: {turn['ttft']:.2f}s")
+    context_plan = turn["context_plan"]
+    if context_plan["sent"] < context_plan["total"]:
+        st.caption(f"Sent {context_plan['sent']} of {context_plan['total']} messages "
+                   f"({context_plan['summarized']} summarized, {context_plan['dropped']} dropped)")
+
+# Display recent chat messages from history on app rerun
+transcript.render(conversation, display_mode)
+
+generation = st.session_state.get("generation")
+
+# Accept user input; disabled while an answer is being generated
+if prompt := st.chat_input("What is your message?", disabled=generation is not None):
     # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    conversation.append({"role": "user", "content": prompt})
     # Display user message in chat message container
     with st.chat_message("user"):
         if display_mode == "Markdown":
@@ -167,40 +261,64 @@ if prompt := st.chat_input("What is your message?"):
         else:
             st.text(prompt)
     
-    # Prepare messages for API call
-    api_messages = []
-    if system_prompt:
-        api_messages.append({"role": "system", "content": system_prompt})
-    api_messages.extend(st.session_state.messages)
+    # Prepare messages for API call, folding turns that no longer fit into the summary
+    api_messages, context_plan = build_api_messages()
+    if context_plan["pending"]:
+        with st.spinner("Summarizing earlier turns..."):
+            summary = chat_history.update_summary(
+                conversation.load_state().get("summary"), conversation, context_plan["pending"], api_key, summary_model)
+            conversation.save_state({"summary": summary})
+        api_messages, context_plan = build_api_messages()
     
-    # Display assistant response in chat message container
+    # Generate on the client loop, so reruns (and the Stop button) don't wait for the answer
+    if model_pool:
+        stream = model_router.start_stream(model_pool, api_messages, api_key, temperature, catalog,
+                                           on_finish=save_answer(conversation))
+    else:
+        stream = openrouter_client.start_stream(api_messages, model_name, api_key, temperature, cache=cache_mode,
+                                                on_finish=save_answer(conversation))
+    st.session_state.generation = {
+        "stream": stream,
+        "routed": bool(model_pool),
+        "context_plan": context_plan,
+    }
+    st.session_state.pop("last_turn", None)
+    st.rerun()
+
+if generation is not None:
+    # Poll the answer. Any widget interaction (including Stop) interrupts this
+    # loop with a rerun; the next run picks the same generation up again
+    stream = generation["stream"]
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        full_response = ""
-        with st.spinner("Thinking..."):
-            assistant_response, usage = call_openrouter_api(api_messages, model_name, temperature, api_key)
-            full_response = assistant_response
-            if display_mode == "Markdown":
-                message_placeholder.markdown(replace_custom_latex_delimiters(full_response))
-            else:
-                message_placeholder.text(full_response)
-    
-    # Add assistant response to chat history
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
-    
+        st.button("Stop generating", on_click=stop_generation)
+        # Converts each new piece once instead of the whole reply on every render
+        converter = latex_delimiters.StreamingConverter()
+        rendered = 0
+        status = None
+        while not stream.done:
+            content = stream.content
+            if not stream_responses or not content:
+                waiting = f"Thinking... {time.perf_counter() - stream.started:.0f}s"
+                if waiting != status:
+                    message_placeholder.caption(waiting)
+                    status = waiting
+            elif len(content) > rendered:
+                converter.feed(content[rendered:])
+                rendered = len(content)
+                transcript.render_message(message_placeholder, content + "▌", display_mode, converter.text() + "▌")
+            stream.finished.wait(STREAM_RENDER_INTERVAL)
+    finish_generation(generation)
+    st.rerun()
+elif "last_turn" in st.session_state:
     # Display usage and cost information
-    if usage:
-        prompt_cost, completion_cost = calculate_cost(usage, model_name)
-        if prompt_cost is not None and completion_cost is not None:
-            total_cost = prompt_cost + completion_cost
-            total_tokens = usage['prompt_tokens'] + usage['completion_tokens']
-            st.caption(f"**Cost**: ${total_cost:.6f}, **Tokens**: {total_tokens}")
-        else:
-            st.caption(f"Error: Model {model_name} not found in models.json")
-    else:
-        st.caption("Usage information not available")
+    render_turn_info(st.session_state.last_turn)
 
 # Add a button to clear the chat history
 if st.button("Clear Chat History"):
-    st.session_state.messages = []
+    # Starts a new conversation; the old one can still be resumed from the sidebar
+    stop_generation()
+    st.session_state.pop("generation", None)
+    st.session_state.pop("last_turn", None)
+    transcript.switch_conversation("chat_app")
     st.rerun()
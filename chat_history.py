@@ -0,0 +1,107 @@
+import openrouter_client
+import token_estimator
+
+# History policies offered in chat_app.py
+POLICY_FULL = "Full history"
+POLICY_WINDOW = "Sliding window"
+POLICY_SUMMARY = "Sliding window + summary"
+POLICIES = [POLICY_FULL, POLICY_WINDOW, POLICY_SUMMARY]
+
+SUMMARY_MODEL = "openai/gpt-4o-mini"  # Cheap model used to summarize dropped turns
+DEFAULT_CONTEXT_LENGTH = 8192  # Assumed when the catalog doesn't know the model
+DEFAULT_COMPLETION_RESERVE = 4096  # Tokens kept free for the answer
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation. Keep facts, decisions, names, numbers "
+    "and open questions that later turns may rely on. Reply with the summary only."
+)
+
+
+def context_budget(model_info, budget_fraction):
+    # Prompt-token target: a fraction of the context window, minus room for the answer
+    model_info = model_info or {}
+    context_length = model_info.get('context_length') or DEFAULT_CONTEXT_LENGTH
+    max_completion = (model_info.get('top_provider') or {}).get('max_completion_tokens') or DEFAULT_COMPLETION_RESERVE
+    reserve = min(max_completion, context_length // 4)
+    return max(0, int(context_length * budget_fraction) - reserve)
+
+
+def summary_message(summary_text):
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary_text}"}
+
+
+def _message_tokens(message, model_id, family):
+    return token_estimator.TOKENS_PER_MESSAGE + token_estimator.count_text_tokens(token_estimator.message_text(message), model_id, family)
+
+
+def plan_window(messages, budget, model_id, family, pin_first, pin_last, fixed_tokens=0):
+    # Keep the first pin_first and last pin_last messages, then fill the budget
+    # with the newest remaining turns. Returns (head, cut): messages[head:cut]
+    # are the ones left out
+    count = len(messages)
+    head = min(pin_first, count)
+    tail_start = max(head, count - pin_last)
+    used = fixed_tokens
+    used += sum(_message_tokens(message, model_id, family) for message in messages[:head])
+    used += sum(_message_tokens(message, model_id, family) for message in messages[tail_start:])
+    cut = tail_start
+    while cut > head:
+        tokens = _message_tokens(messages[cut - 1], model_id, family)
+        if used + tokens > budget:
+            break
+        used += tokens
+        cut -= 1
+    return head, cut
+
+
+def build_context(system_prompt, messages, model_id, model_info, settings, summary=None):
+    # settings: dict with policy, budget_fraction, pin_first and pin_last.
+    # summary: {"text": ..., "covered": n} meaning messages[head:n] are summarized.
+    # Returns (api_messages, plan); plan["pending"] is the slice that a summary
+    # would still have to cover
+    system = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    plan = {"sent": len(messages), "total": len(messages), "dropped": 0, "summarized": 0, "pending": None}
+    if settings["policy"] == POLICY_FULL:
+        return system + messages[:], plan
+
+    family = token_estimator.tokenizer_family(model_info)
+    budget = context_budget(model_info, settings["budget_fraction"])
+    fixed_tokens = token_estimator.count_message_tokens(system, model_id, family)
+    use_summary = settings["policy"] == POLICY_SUMMARY and summary and summary.get("text")
+    if use_summary:
+        fixed_tokens += _message_tokens(summary_message(summary["text"]), model_id, family)
+    head, cut = plan_window(messages, budget, model_id, family, settings["pin_first"], settings["pin_last"], fixed_tokens)
+
+    api_messages = system + messages[:head]
+    if use_summary and summary["covered"] > head:
+        covered = min(summary["covered"], len(messages))
+        api_messages.append(summary_message(summary["text"]))
+        plan["summarized"] = covered - head
+        start = max(cut, covered)
+    else:
+        covered = head
+        start = cut
+    if settings["policy"] == POLICY_SUMMARY and cut > covered:
+        plan["pending"] = (covered, cut)
+    api_messages += messages[start:]
+    plan["sent"] = head + len(messages) - start
+    plan["dropped"] = len(messages) - plan["sent"] - plan["summarized"]
+    return api_messages, plan
+
+
+def update_summary(summary, messages, pending, api_key, model=SUMMARY_MODEL):
+    # Fold messages[pending[0]:pending[1]] into the rolling summary. Returns the
+    # new summary, or the old one if the summarization call failed
+    start, end = pending
+    transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages[start:end])
+    previous = (summary or {}).get("text") or "(empty)"
+    content, usage = openrouter_client.call_openrouter_api(
+        [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{previous}\n\nNew turns:\n{transcript}"},
+        ],
+        model, api_key, temperature=0,
+    )
+    if usage is None:
+        return summary
+    return {"text": content.strip(), "covered": end}
@@ -0,0 +1,236 @@
+import collections
+import collections.abc
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Conversation store settings (override with environment variables)
+STORE_PATH = os.getenv("CONVERSATION_STORE_PATH", ".conversations.sqlite")  # Empty string keeps conversations in memory
+HOT_MESSAGES = int(os.getenv("CONVERSATION_HOT_MESSAGES", "40"))  # Newest messages kept in memory per conversation
+PAGE_SIZE = 64  # Older messages are read from disk this many at a time
+COLD_PAGES = 4  # Pages of older messages kept per conversation
+TITLE_LENGTH = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    app TEXT NOT NULL,
+    owner TEXT,
+    title TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    state TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (conversation, position)
+) WITHOUT ROWID;
+"""
+
+_lock = threading.Lock()
+_db = None
+
+
+def connect(path=STORE_PATH):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps the store consistent after a crash; an OS crash may lose the last turn
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    if "owner" not in {row[1] for row in db.execute("PRAGMA table_info(conversations)")}:
+        # Stores created before conversations had owners; their conversations stay unowned and can't be resumed
+        db.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+    db.execute("CREATE INDEX IF NOT EXISTS conversations_owner_app_updated ON conversations (owner, app, updated)")
+    return db
+
+
+@contextlib.contextmanager
+def _connection():
+    # One connection per process, shared by all Streamlit sessions. Statements
+    # are short, so serializing them is cheaper than a connection per thread
+    global _db
+    with _lock:
+        if _db is None:
+            _db = connect()
+        yield _db
+
+
+def _message(role, content):
+    return {"role": role, "content": content}
+
+
+def _owner_hash(owner):
+    # Only a hash of the owner key is stored, so the database doesn't hand out keys
+    return hashlib.sha256(owner.encode("utf-8")).hexdigest()
+
+
+class Conversation(collections.abc.Sequence):
+    # The messages of one conversation as a read-only sequence, persisted turn
+    # by turn with append(). Only the newest HOT_MESSAGES stay in memory; older
+    # ones are read from disk a page at a time when indexed or sliced, and only
+    # COLD_PAGES pages are kept. Without a STORE_PATH everything stays in memory.
+    # owner is the hash of the owner key; only that owner can load it again
+    def __init__(self, conversation_id, app, owner, count=0, hot=None):
+        self.id = conversation_id
+        self.app = app
+        self.owner = owner
+        self._count = count
+        self._hot = list(hot or [])  # The last len(_hot) messages
+        self._pages = collections.OrderedDict()
+        self._state = {}  # Only used without a STORE_PATH
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Pages read for this slice, partial ones included, are reused within it
+            pages = {}
+            return [self._get(i, pages) for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("conversation index out of range")
+        return self._get(index)
+
+    def _get(self, index, pages=None):
+        hot_start = self._count - len(self._hot)
+        if index >= hot_start:
+            return self._hot[index - hot_start]
+        number = index // PAGE_SIZE
+        page = pages.get(number) if pages is not None else None
+        if page is None:
+            page = self._page(number)
+            if pages is not None:
+                pages[number] = page
+        return page[index % PAGE_SIZE]
+
+    def _page(self, number):
+        page = self._pages.get(number)
+        if page is not None:
+            self._pages.move_to_end(number)
+            return page
+        with _connection() as db:
+            rows = db.execute(
+                "SELECT role, content FROM messages WHERE conversation = ? AND position >= ? AND position < ? ORDER BY position",
+                (self.id, number * PAGE_SIZE, (number + 1) * PAGE_SIZE)).fetchall()
+        page = [_message(role, content) for role, content in rows]
+        # A partial page still grows as messages leave the hot window, so it isn't kept
+        if len(page) == PAGE_SIZE:
+            self._pages[number] = page
+            while len(self._pages) > COLD_PAGES:
+                self._pages.popitem(last=False)
+        return page
+
+    def append(self, message):
+        message = _message(message["role"], message["content"])
+        if STORE_PATH:
+            now = time.time()
+            title = message["content"].strip().splitlines()[0][:TITLE_LENGTH] if message["role"] == "user" and message["content"].strip() else None
+            with _connection() as db, db:
+                db.execute("INSERT OR IGNORE INTO conversations (id, app, owner, created, updated) VALUES (?, ?, ?, ?, ?)",
+                           (self.id, self.app, self.owner, now, now))
+                count, owner = db.execute("SELECT message_count, owner FROM conversations WHERE id = ?", (self.id,)).fetchone()
+                if owner != self.owner:
+                    raise PermissionError(f"conversation {self.id} belongs to another owner")
+                db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                           (self.id, count, message["role"], message["content"], now))
+                db.execute("UPDATE conversations SET updated = ?, message_count = ?, title = COALESCE(title, ?) WHERE id = ?",
+                           (now, count + 1, title, self.id))
+            if count != self._count:
+                # Another tab appended to this conversation; its messages are read from disk when needed
+                self._count = count
+                self._hot = []
+                self._pages.clear()
+        self._hot.append(message)
+        self._count += 1
+        if STORE_PATH and len(self._hot) > HOT_MESSAGES:
+            del self._hot[0]
+
+    def load_state(self):
+        # Small per-conversation values (e.g. the history summary), read on demand
+        if not STORE_PATH:
+            return dict(self._state)
+        with _connection() as db:
+            row = db.execute("SELECT state FROM conversations WHERE id = ? AND owner = ?", (self.id, self.owner)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def save_state(self, state, title=None):
+        if not STORE_PATH:
+            self._state = dict(state)
+            return
+        now = time.time()
+        with _connection() as db, db:
+            db.execute("INSERT OR IGNORE INTO conversations (id, app, owner, created, updated) VALUES (?, ?, ?, ?, ?)",
+                       (self.id, self.app, self.owner, now, now))
+            db.execute("UPDATE conversations SET updated = ?, state = ?, title = COALESCE(?, title) WHERE id = ? AND owner = ?",
+                       (now, json.dumps(state), title and title[:TITLE_LENGTH], self.id, self.owner))
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+
+def create(app, owner, conversation_id=None):
+    # A new, empty conversation of owner (an owner key). Nothing is written
+    # until its first message or state
+    return Conversation(conversation_id or new_id(), app, _owner_hash(owner))
+
+
+def load(conversation_id, owner):
+    # Reopen a stored conversation of owner with only its newest messages in
+    # memory, or None (also when it belongs to someone else)
+    if not STORE_PATH or not conversation_id:
+        return None
+    owner = _owner_hash(owner)
+    with _connection() as db:
+        row = db.execute("SELECT app, message_count FROM conversations WHERE id = ? AND owner = ?",
+                         (conversation_id, owner)).fetchone()
+        if row is None:
+            return None
+        app, count = row
+        rows = db.execute("SELECT role, content FROM messages WHERE conversation = ? AND position >= ? ORDER BY position",
+                          (conversation_id, count - HOT_MESSAGES)).fetchall()
+    return Conversation(conversation_id, app, owner, count, [_message(role, content) for role, content in rows])
+
+
+def _is_taken(conversation_id):
+    if not STORE_PATH:
+        return False
+    with _connection() as db:
+        return db.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone() is not None
+
+
+def open_or_create(app, owner, conversation_id=None):
+    # Resume conversation_id if owner stored it, otherwise start it. An id
+    # that is someone else's is never resumed: a new conversation is started
+    conversation = load(conversation_id, owner)
+    if conversation is not None:
+        return conversation
+    if conversation_id and _is_taken(conversation_id):
+        conversation_id = None
+    return create(app, owner, conversation_id)
+
+
+def recent(owner, app=None, limit=20):
+    # [{"id", "title", "updated", "messages"}] of owner's stored conversations, newest first
+    if not STORE_PATH:
+        return []
+    query = "SELECT id, title, updated, message_count FROM conversations WHERE owner = ?"
+    params = (_owner_hash(owner),)
+    if app is not None:
+        query += " AND app = ?"
+        params += (app,)
+    with _connection() as db:
+        rows = db.execute(query + " ORDER BY updated DESC LIMIT ?", params + (limit,)).fetchall()
+    return [{"id": row[0], "title": row[1], "updated": row[2], "messages": row[3]} for row in rows]
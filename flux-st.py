@@ -1,21 +1,78 @@
 import streamlit as st
 import os
+import concurrent.futures
+import random
 from openai import OpenAI
+import image_store
 
-def get_flux_image(api_key, prompt="A flying cat", model="black-forest-labs/FLUX.1-schnell-Free"):
+TOGETHER_BASE_URL = "https://api.together.xyz/v1"
+GRID_COLUMNS = 4  # Variants per row in the grid
+
+@st.cache_resource
+def get_client(api_key):
+    # One client (and connection pool) per key, reused across reruns; it is
+    # thread-safe, so concurrent variants share its connections
+    return OpenAI(api_key=api_key, base_url=TOGETHER_BASE_URL)
+
+def generate_image(client, prompt, model, seed=None):
     try:
-        client = OpenAI(
-            api_key=api_key, base_url="https://api.together.xyz/v1"
-        )
         response = client.images.generate(
             prompt=prompt,
             model=model,
             n=1,
+            extra_body={"seed": seed} if seed is not None else None,
         )
         return response.data[0].url
     except Exception as e:
         return str(e)
 
+def get_flux_image(api_key, prompt="A flying cat", model="black-forest-labs/FLUX.1-schnell-Free", seed=None):
+    return generate_image(get_client(api_key), prompt, model, seed)
+
+def render_image(image, caption, full_size=False):
+    # Serve the local copy (a thumbnail unless full_size) once it is downloaded;
+    # the provider URL is only used until then
+    if "https://" in image:
+        image_store.prefetch(image)
+        local = image_store.local_path(image) if full_size else image_store.thumbnail_path(image)
+        st.image(local or image, caption=caption)
+    else:
+        st.error(image)
+
+def generate_variants(api_key, prompt, variant_models, seeds_per_model):
+    # Every (model, seed) pair is requested at once; each grid cell is filled
+    # in as soon as its image lands
+    client = get_client(api_key)
+    base_seed = random.randrange(2 ** 31)
+    jobs = [(model, base_seed + i) for model in variant_models for i in range(seeds_per_model)]
+    cells = []
+    for start in range(0, len(jobs), GRID_COLUMNS):
+        for column in st.columns(GRID_COLUMNS)[:len(jobs) - start]:
+            cells.append(column.empty())
+    variants = [None] * len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs) or 1, thread_name_prefix="flux") as executor:
+        futures = {}
+        for index, (model, seed) in enumerate(jobs):
+            cells[index].info(f"Generating {model.split('/')[-1]} (seed {seed})...")
+            futures[executor.submit(generate_image, client, prompt, model, seed)] = index
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            model, seed = jobs[index]
+            variants[index] = {"model": model, "seed": seed, "image": future.result()}
+            if "https://" in variants[index]["image"]:
+                image_store.prefetch(variants[index]["image"])
+            with cells[index].container():
+                render_image(variants[index]["image"], f"{model.split('/')[-1]}, seed {seed}")
+    return variants
+
+def promote_variant(index):
+    # Make the chosen variant the next refinement step
+    variant_set = st.session_state.variants
+    st.session_state.prompts.append(variant_set["prompt"])
+    st.session_state.images.append(variant_set["variants"][index]["image"])
+    st.session_state.current_step += 1
+    st.session_state.variants = None
+
 def main():
     st.title("FLUX Image Generator")
     st.subheader("Prompt Refinement Exercise")
@@ -27,6 +84,8 @@ def main():
         st.session_state.images = []
     if 'current_step' not in st.session_state:
         st.session_state.current_step = 0
+    if 'variants' not in st.session_state:
+        st.session_state.variants = None
 
     # Input field for API key
     api_key = st.text_input("TogetherAI API Key", type="password")
@@ -51,7 +110,9 @@ def main():
         )
         if st.session_state.images[i]:
             if "https://" in st.session_state.images[i]:
-                st.image(st.session_state.images[i], caption=f"Generated Image {i + 1}")
+                # History shows thumbnails; full resolution only when asked for
+                full_size = st.checkbox("Full size", key=f"full_size_{i}")
+                render_image(st.session_state.images[i], f"Generated Image {i + 1}", full_size)
             else:
                 st.error(f"Error in step {i + 1}: {st.session_state.images[i]}")
         
@@ -88,8 +149,37 @@ def main():
         key=f"current_prompt"
     )
 
+    # Generate several seeds and/or models at once, then pick one to continue from
+    variant_mode = st.toggle("Generate variants")
+    if variant_mode:
+        variant_models = st.multiselect("Variant models", models, default=[selected_model])
+        seeds_per_model = st.radio("Seeds per model", options=[1, 2, 3, 4], index=3 if len(variant_models) <= 1 else 0, horizontal=True)
+
     # Button to generate image
-    if st.button("Generate Image"):
+    if variant_mode and st.button("Generate Variants"):
+        if not api_key:
+            st.warning("Please enter your TogetherAI API key.")
+        elif not current_prompt:
+            st.warning("Please enter a prompt.")
+        elif not variant_models:
+            st.warning("Please select at least one model.")
+        else:
+            variants = generate_variants(api_key, current_prompt, variant_models, seeds_per_model)
+            st.session_state.variants = {"prompt": current_prompt, "variants": variants}
+            st.rerun()
+
+    if st.session_state.variants:
+        st.markdown("#### Variants")
+        variant_set = st.session_state.variants["variants"]
+        for start in range(0, len(variant_set), GRID_COLUMNS):
+            for index, column in enumerate(st.columns(GRID_COLUMNS)[:len(variant_set) - start], start):
+                variant = variant_set[index]
+                with column:
+                    render_image(variant["image"], f"{variant['model'].split('/')[-1]}, seed {variant['seed']}")
+                    if "https://" in variant["image"]:
+                        st.button("Use this", key=f"promote_{index}", on_click=promote_variant, args=(index,))
+
+    if not variant_mode and st.button("Generate Image"):
         if api_key:
             if current_prompt:
                 with st.spinner("Generating image..."):
@@ -112,6 +202,7 @@ def main():
         st.session_state.prompts = []
         st.session_state.images = []
         st.session_state.current_step = 0
+        st.session_state.variants = None
         st.rerun()
 
 if __name__ == "__main__":
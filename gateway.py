@@ -0,0 +1,404 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+import catalog_refresher
+import latex_delimiters
+import metrics
+import model_router
+import openrouter_client
+import pricing_engine
+import prompt_engine
+import response_cache
+import token_estimator
+import usage_ledger
+
+# Headless JSON API over the prompt editor's engine, for other services.
+# Run with `python gateway.py --workers 4`; each worker process has its own
+# client loop and connection pool, shared by all requests it serves
+
+load_dotenv()
+
+# Gateway settings (override with environment variables)
+HOST = os.getenv("GATEWAY_HOST", "127.0.0.1")
+PORT = int(os.getenv("GATEWAY_PORT", "8100"))
+WORKERS = int(os.getenv("GATEWAY_WORKERS", "1"))
+MAX_RESPONSES = 8  # Upper bound for "n" on /v1/samples
+MAX_BODY_BYTES = 1 << 20
+CATALOG_CHECK_INTERVAL = 30  # Seconds between catalog freshness checks per worker
+TITLE = "OpenRouter Gateway"
+
+CACHE_MODES = (response_cache.CACHE_OFF, response_cache.CACHE_DETERMINISTIC, response_cache.CACHE_ALWAYS)
+
+_catalog = None
+_catalog_checked = 0.0
+_models_body = (None, None)  # (catalog, encoded /v1/models response)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _on_client_loop(coro):
+    # The connection pool lives on openrouter_client's loop, not the server's;
+    # this awaits coro there. Cancelling the returned future cancels coro too
+    return asyncio.wrap_future(openrouter_client.submit(coro))
+
+
+async def _get_catalog(api_key):
+    # get_catalog() reads a file and may fetch, so it runs off the server loop
+    global _catalog, _catalog_checked
+    if _catalog is None or time.monotonic() - _catalog_checked >= CATALOG_CHECK_INTERVAL:
+        _catalog_checked = time.monotonic()
+        _catalog = await asyncio.to_thread(catalog_refresher.get_catalog, api_key)
+        usage_ledger.use_catalog(_catalog)
+    return _catalog
+
+
+def _header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _api_key(scope):
+    # Callers may pass their own OpenRouter key; otherwise the gateway's is used
+    authorization = _header(scope, b"authorization") or ""
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise HTTPError(401, "No OpenRouter API key: send 'Authorization: Bearer <key>' or set OPENROUTER_API_KEY")
+    return api_key
+
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "Request body is not valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "Request body must be a JSON object")
+    return data
+
+
+async def _send(send, status, body, content_type=b"application/json"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status, data):
+    await _send(send, status, json.dumps(data).encode("utf-8"))
+
+
+def _messages(request):
+    # Either a chat "messages" list or the prompt editor's prompt/system_prompt
+    if "messages" in request:
+        messages = request["messages"]
+        if not isinstance(messages, list) or not messages or not all(
+                isinstance(message, dict) and isinstance(message.get("role"), str) and isinstance(message.get("content"), str)
+                for message in messages):
+            raise HTTPError(400, "'messages' must be a non-empty list of {role, content} objects with string content")
+        return messages
+    if not isinstance(request.get("prompt"), str):
+        raise HTTPError(400, "Send 'prompt' (and optionally 'system_prompt') or 'messages'")
+    return prompt_engine.build_messages(_system_prompt(request), _prompt(request))
+
+
+def _prompt(request):
+    if not isinstance(request.get("prompt"), str) or not request["prompt"].strip():
+        raise HTTPError(400, "'prompt' is required")
+    return request["prompt"]
+
+
+def _system_prompt(request):
+    system_prompt = request.get("system_prompt")
+    if system_prompt is not None and not isinstance(system_prompt, str):
+        raise HTTPError(400, "'system_prompt' must be a string")
+    return system_prompt
+
+
+def _integer(request, name, default, minimum, maximum=None):
+    # bool is an int subclass, so true/false are rejected explicitly
+    value = request.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum or (maximum is not None and value > maximum):
+        bounds = f"from {minimum} to {maximum}" if maximum is not None else f"of at least {minimum}"
+        raise HTTPError(400, f"'{name}' must be an integer {bounds}")
+    return value
+
+
+def _temperature(request, default=None):
+    temperature = request.get("temperature")
+    if temperature is None:
+        return default
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2:
+        raise HTTPError(400, "'temperature' must be a number from 0 to 2")
+    return temperature
+
+
+def _model(request):
+    # A model id, or a pool of them ("models") to route between; returns (model, pool)
+    models = request.get("models")
+    if models is not None:
+        if not isinstance(models, list) or not models or not all(isinstance(model, str) and model for model in models):
+            raise HTTPError(400, "'models' must be a non-empty list of model ids")
+        return None, models
+    model = request.get("model")
+    if not isinstance(model, str) or not model:
+        raise HTTPError(400, "'model' (or a 'models' pool) is required")
+    return model, None
+
+
+def _cache_mode(request):
+    # Identical in-flight requests that may be cached share one upstream call,
+    # so by default concurrent temperature 0 duplicates are coalesced
+    mode = request.get("cache", response_cache.CACHE_DETERMINISTIC)
+    if mode not in CACHE_MODES:
+        raise HTTPError(400, f"'cache' must be one of {', '.join(CACHE_MODES)}")
+    return mode
+
+
+def _params(request):
+    params = {}
+    max_tokens = _integer(request, "max_tokens", None, 1)
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    return params
+
+
+def _result(pricing, model, content, usage):
+    if usage is None:
+        return {"content": None, "usage": None, "cost": None, "error": content}
+    return {"content": content, "usage": usage, "cost": prompt_engine.total_cost(pricing, usage, model), "error": None}
+
+
+async def completions(scope, receive, send):
+    # With a "models" pool the model is picked per request by model_router,
+    # failing over down its ranking; "model" in the response says which answered
+    request = await _read_json(receive)
+    model, pool = _model(request)
+    messages = _messages(request)
+    temperature = _temperature(request)
+    params = _params(request)
+    api_key = _api_key(scope)
+    catalog = await _get_catalog(api_key)
+    pricing = pricing_engine.for_catalog(catalog)
+    if request.get("stream"):
+        return await _stream_completion(receive, send, pricing, catalog, model, pool, messages, temperature, params, api_key)
+    cache = _cache_mode(request)
+    if pool:
+        content, usage, model = await _on_client_loop(model_router.call_async(
+            pool, messages, api_key, temperature, catalog, TITLE, cache, **params))
+    else:
+        content, usage = await _on_client_loop(openrouter_client.call_openrouter_api_async(
+            messages, model, api_key, temperature, title=TITLE, cache=cache, **params))
+    if usage is not None:
+        content = latex_delimiters.convert(content)
+    result = _result(pricing, model, content, usage)
+    await _send_json(send, 200 if usage is not None else 502, dict(result, model=model))
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _stream_completion(receive, send, pricing, catalog, model, pool, messages, temperature, params, api_key):
+    # Server-sent events: {"delta": ...} per chunk as it arrives, then one
+    # {"done": true, ...} event with usage and cost. Deltas are raw model
+    # output; a client that disconnects cancels the upstream generation
+    loop = asyncio.get_running_loop()
+    deltas = asyncio.Queue()
+    result = openrouter_client.StreamResult()
+    on_delta = lambda delta: loop.call_soon_threadsafe(deltas.put_nowait, delta)
+    if pool:
+        stream = model_router.stream_async(pool, messages, api_key, temperature, catalog, TITLE,
+                                           on_delta=on_delta, result=result, **params)
+    else:
+        stream = openrouter_client.stream_openrouter_api_async(messages, model, api_key, temperature, title=TITLE,
+                                                               result=result, on_delta=on_delta, **params)
+    future = _on_client_loop(stream)
+    future.add_done_callback(lambda _: deltas.put_nowait(None))
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+    try:
+        while True:
+            next_delta = asyncio.ensure_future(deltas.get())
+            await asyncio.wait({next_delta, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_delta.done():
+                next_delta.cancel()
+                future.cancel()
+                return
+            delta = next_delta.result()
+            if delta is None:
+                break
+            await send({"type": "http.response.body", "body": f"data: {json.dumps({'delta': delta})}\n\n".encode("utf-8"), "more_body": True})
+        usage = None if result.error else result.usage
+        model = getattr(result, "model", model)
+        done = {"done": True, "model": model, "usage": usage, "cost": prompt_engine.total_cost(pricing, usage, model),
+                "error": result.error, "ttft": result.ttft, "elapsed": result.elapsed}
+        await send({"type": "http.response.body", "body": f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode("utf-8")})
+    finally:
+        disconnected.cancel()
+
+
+async def samples(scope, receive, send):
+    # Several responses to one prompt, as the prompt editor makes them: one
+    # n-choice request where the model supports it, else a concurrent fan-out
+    request = await _read_json(receive)
+    model, pool = _model(request)
+    prompt = _prompt(request)
+    system_prompt = _system_prompt(request)
+    n = _integer(request, "n", 1, 1, MAX_RESPONSES)
+    temperature = _temperature(request, 1.0)
+    cache = _cache_mode(request)
+    api_key = _api_key(scope)
+    catalog = await _get_catalog(api_key)
+    pricing = pricing_engine.for_catalog(catalog)
+    models = model_router.rank(pool, catalog) if pool else [model]
+    model, responses = await _on_client_loop(prompt_engine.get_routed_responses_async(
+        system_prompt, prompt, n, models, temperature, api_key, cache, TITLE))
+    await _send_json(send, 200, {"model": model, "responses": [_result(pricing, model, content, usage) for content, usage in responses]})
+
+
+async def estimate(scope, receive, send):
+    # Local token count and cost estimate; nothing is sent to OpenRouter
+    request = await _read_json(receive)
+    model, pool = _model(request)
+    messages = _messages(request)
+    completion_tokens = _integer(request, "completion_tokens", 0, 0)
+    catalog = await _get_catalog(os.getenv("OPENROUTER_API_KEY"))
+    # For a pool, the estimate is for the model a request would be routed to now
+    model = model or model_router.rank(pool, catalog)[0]
+    model_info = catalog.get(model) if catalog else None
+    result = token_estimator.estimate_request(messages, model, model_info)
+    completion_cost = None
+    if model_info:
+        completion_cost = float(model_info['pricing'].get('completion', 0)) * completion_tokens
+    result.update(model=model, known_model=model_info is not None, completion_tokens=completion_tokens, completion_cost=completion_cost,
+                  total_cost=None if completion_cost is None else result["prompt_cost"] + completion_cost)
+    await _send_json(send, 200, result)
+
+
+async def models(scope, receive, send):
+    # The encoded list is reused until the catalog is refreshed
+    global _models_body
+    catalog = await _get_catalog(os.getenv("OPENROUTER_API_KEY"))
+    if catalog is None:
+        raise HTTPError(503, "The model catalog is not available yet")
+    if _models_body[0] is not catalog:
+        data = [
+            {
+                "id": model_id,
+                "name": catalog.models[model_id].get('name'),
+                "context_length": catalog.models[model_id].get('context_length'),
+                "pricing": catalog.models[model_id].get('pricing'),
+            }
+            for model_id in catalog.ids
+        ]
+        _models_body = (catalog, json.dumps({"data": data}).encode("utf-8"))
+    await _send(send, 200, _models_body[1])
+
+
+async def health(scope, receive, send):
+    await _send_json(send, 200, {"status": "ok"})
+
+
+async def prometheus(scope, receive, send):
+    # This worker's request metrics
+    await _send(send, 200, metrics.render_prometheus().encode("utf-8"), b"text/plain; version=0.0.4")
+
+
+ROUTES = {
+    ("POST", "/v1/completions"): completions,
+    ("POST", "/v1/samples"): samples,
+    ("POST", "/v1/estimate"): estimate,
+    ("GET", "/v1/models"): models,
+    ("GET", "/healthz"): health,
+    ("GET", "/metrics"): prometheus,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Start the client loop before the first request needs it
+            openrouter_client.get_loop()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            usage_ledger.flush()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    started = False
+
+    async def tracked_send(message):
+        nonlocal started
+        started = started or message["type"] == "http.response.start"
+        await send(message)
+
+    try:
+        if handler is None:
+            if any(path == scope["path"] for _, path in ROUTES):
+                raise HTTPError(405, "Method not allowed")
+            raise HTTPError(404, "Not found")
+        user = _header(scope, b"x-user")
+        if user:
+            # Attribute the request in the usage ledger
+            usage_ledger.set_context(user=user)
+        await handler(scope, receive, tracked_send)
+    except HTTPError as e:
+        # Handlers validate the request before they start a response
+        await _send_json(send, e.status, {"error": e.message})
+    except Exception:
+        # A bug, not a bad request. Once a response (e.g. an event stream) has
+        # started, a second one would break the protocol: the server closes it
+        if not started:
+            await _send_json(send, 500, {"error": "Internal server error"})
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the prompt editor's engine as a JSON API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    uvicorn.run("gateway:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
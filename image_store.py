@@ -0,0 +1,192 @@
+import concurrent.futures
+import glob
+import hashlib
+import io
+import os
+import threading
+import time
+
+import requests
+from PIL import Image
+
+# Image store settings (override with environment variables)
+STORE_DIR = os.getenv("IMAGE_STORE_DIR", ".image_store")
+THUMBNAIL_SIZE = int(os.getenv("IMAGE_STORE_THUMBNAIL_SIZE", "320"))  # Longest side in pixels
+MAX_BYTES = float(os.getenv("IMAGE_STORE_MAX_MB", "1024")) * 1024 * 1024  # Full-size images kept on disk (0 = no limit)
+MAX_AGE = float(os.getenv("IMAGE_STORE_MAX_AGE_DAYS", "30")) * 86400  # Images unused this long are removed (0 = never)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = (10, 60)  # Connect and read seconds
+EVICT_INTERVAL = 60  # Seconds between eviction passes
+
+# File extension for each Pillow format, so Streamlit can serve blobs with the right type
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif"}
+
+_lock = threading.Lock()
+_pending = {}  # url -> Future of the download in progress
+_local = {}  # url -> blob path, for URLs already stored
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="image-store")
+_session = None
+_last_eviction = 0.0
+
+
+def _get_session():
+    # Image hosts are unrelated to the chat providers, so downloads have their own keep-alive pool
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+        return _session
+
+
+def _url_index_path(url):
+    return os.path.join(STORE_DIR, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+
+def _thumbnail_path(blob_path, size):
+    digest = os.path.splitext(os.path.basename(blob_path))[0]
+    return os.path.join(STORE_DIR, "thumbs", f"{digest}_{size}.jpg")
+
+
+def _write_atomic(path, data):
+    # Concurrent writers (threads or app processes) never expose a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _make_thumbnail(image, path, size):
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((size, size))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="JPEG", quality=85)
+    _write_atomic(path, buffer.getvalue())
+
+
+def _download(url):
+    response = _get_session().get(url, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    data = response.content
+    # Content-addressed: the same image under several URLs is stored once
+    digest = hashlib.sha256(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as image:
+        extension = EXTENSIONS.get(image.format, "png")
+        blob_path = os.path.join(STORE_DIR, "blobs", digest[:2], f"{digest}.{extension}")
+        if os.path.exists(blob_path):
+            os.utime(blob_path)
+        else:
+            _write_atomic(blob_path, data)
+        thumbnail_path = _thumbnail_path(blob_path, THUMBNAIL_SIZE)
+        if not os.path.exists(thumbnail_path):
+            _make_thumbnail(image, thumbnail_path, THUMBNAIL_SIZE)
+    _write_atomic(_url_index_path(url), blob_path.encode("utf-8"))
+    _evict()
+    return blob_path
+
+
+def _evict():
+    # Removes images unused for MAX_AGE, then the least recently used ones
+    # until the blobs fit in MAX_BYTES, with their thumbnails and URL entries.
+    # Runs on a download thread at most every EVICT_INTERVAL seconds
+    global _last_eviction
+    now = time.time()
+    with _lock:
+        if now - _last_eviction < EVICT_INTERVAL:
+            return
+        _last_eviction = now
+    blobs = []
+    for path in glob.glob(os.path.join(STORE_DIR, "blobs", "*", "*")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        blobs.append((stat.st_mtime, stat.st_size, path))
+    blobs.sort()
+    total = sum(size for _, size, _ in blobs)
+    removed = set()
+    for used, size, path in blobs:
+        if not (MAX_AGE and now - used > MAX_AGE) and not (MAX_BYTES and total > MAX_BYTES):
+            break
+        digest = os.path.splitext(os.path.basename(path))[0]
+        for stale in [path] + glob.glob(os.path.join(STORE_DIR, "thumbs", f"{digest}_*.jpg")):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        total -= size
+        removed.add(path)
+    if not removed:
+        return
+    with _lock:
+        for url in [url for url, path in _local.items() if path in removed]:
+            del _local[url]
+    for index_path in glob.glob(os.path.join(STORE_DIR, "urls", "*")):
+        try:
+            with open(index_path, 'rb') as f:
+                if f.read().decode("utf-8") in removed:
+                    os.remove(index_path)
+        except OSError:
+            pass
+
+
+def _finish(url, future):
+    with _lock:
+        _pending.pop(url, None)
+        if not future.cancelled() and future.exception() is None:
+            _local[url] = future.result()
+
+
+def prefetch(url):
+    # Start downloading url in the background unless it is stored or on its
+    # way. Returns a Future of the local path
+    path = local_path(url)
+    if path is not None:
+        future = concurrent.futures.Future()
+        future.set_result(path)
+        return future
+    with _lock:
+        future = _pending.get(url)
+        started = future is None
+        if started:
+            future = _pending[url] = _executor.submit(_download, url)
+    if started:
+        # Outside the lock: the callback runs right away if the download already finished
+        future.add_done_callback(lambda done: _finish(url, done))
+    return future
+
+
+def local_path(url):
+    # Full-resolution local copy of url, or None if it hasn't been downloaded
+    with _lock:
+        if url in _local:
+            return _local[url]
+    try:
+        with open(_url_index_path(url), 'rb') as f:
+            path = f.read().decode("utf-8")
+    except OSError:
+        return None
+    try:
+        # Marks the image as used, for eviction
+        os.utime(path)
+    except OSError:
+        return None
+    with _lock:
+        _local[url] = path
+    return path
+
+
+def thumbnail_path(url, size=THUMBNAIL_SIZE):
+    # Downscaled local copy of url, made on first use; None until downloaded
+    path = local_path(url)
+    if path is None:
+        return None
+    thumbnail = _thumbnail_path(path, size)
+    if not os.path.exists(thumbnail):
+        try:
+            with Image.open(path) as image:
+                _make_thumbnail(image, thumbnail, size)
+        except (OSError, ValueError):
+            return None
+    return thumbnail
+
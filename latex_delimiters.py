@@ -0,0 +1,77 @@
+import re
+from functools import lru_cache
+
+# \( ... \) on one line becomes $...$ and \[ ... \] (across lines) becomes
+# $$...$$, in a single scan. Inline math nested in a display block is
+# converted as part of the block
+DELIMITERS = re.compile(r"\\\((.*?)\\\)|\\\[((?s:.*?))\\\]")
+INLINE = re.compile(r"\\\((.*?)\\\)")
+OPENER = re.compile(r"\\[(\[]")
+
+
+def _replace(match):
+    inline, display = match.groups()
+    if display is None:
+        return f"${inline}$"
+    if "\\(" in display:
+        display = INLINE.sub(r"$\1$", display)
+    return f"$${display}$$"
+
+
+@lru_cache(maxsize=2048)
+def convert(text):
+    # Memoized: Streamlit keeps the same str objects across reruns and str
+    # caches its hash, so unchanged history costs one dict lookup per message
+    return DELIMITERS.sub(_replace, text)
+
+
+class StreamingConverter:
+    # Converts a streamed reply chunk by chunk. Text up to the first delimiter
+    # that can't be decided yet (an opener without its closer, or a trailing
+    # backslash) is converted once and never looked at again; the undecided
+    # rest is re-converted for display only. finish() equals convert(full text)
+    def __init__(self):
+        self._done = []
+        self._pending = ""
+
+    def feed(self, chunk):
+        self._pending += chunk
+        text = self._pending
+        position = 0
+        while True:
+            match = OPENER.search(text, position)
+            if match is None:
+                # Keep a trailing backslash: the next chunk may complete an opener
+                end = len(text) - 1 if text.endswith("\\") else len(text)
+                self._done.append(text[position:end])
+                position = end
+                break
+            start = match.start()
+            self._done.append(text[position:start])
+            if match.group() == "\\(":
+                close = text.find("\\)", start + 2)
+                newline = text.find("\n", start + 2)
+                if newline != -1 and (close == -1 or newline < close):
+                    # No inline match at this opener; the scan resumes after its backslash
+                    self._done.append("\\")
+                    position = start + 1
+                    continue
+            else:
+                close = text.find("\\]", start + 2)
+            if close == -1:
+                position = start
+                break
+            self._done.append(_replace(DELIMITERS.match(text, start)))
+            position = close + 2
+        self._pending = text[position:]
+
+    def text(self):
+        # Everything so far, for rendering while the stream is still running
+        self._done = ["".join(self._done)]
+        return self._done[0] + DELIMITERS.sub(_replace, self._pending)
+
+    def finish(self):
+        result = self.text()
+        self._done = [result]
+        self._pending = ""
+        return result
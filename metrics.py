@@ -0,0 +1,232 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics settings (override with environment variables)
+LOG_PATH = os.getenv("OPENROUTER_METRICS_LOG", ".request_metrics.jsonl")  # Empty string disables the JSONL log
+PORT = int(os.getenv("OPENROUTER_METRICS_PORT", "0"))  # Serve /metrics on this port (0 disables)
+RECENT_SECONDS = float(os.getenv("OPENROUTER_METRICS_RECENT_SECONDS", "600"))  # Age limit of recent() attempts
+RECENT_SIZE = 50  # Attempts per model kept for recent()
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 120, 160, 240, 320)
+
+HISTOGRAMS = {
+    "latency": ("openrouter_request_latency_seconds", "Total request latency", SECONDS_BUCKETS),
+    "ttft": ("openrouter_time_to_first_token_seconds", "Time to the first streamed token", SECONDS_BUCKETS),
+    "dns": ("openrouter_dns_seconds", "DNS lookup, when the resolver cache missed", SECONDS_BUCKETS),
+    "connect": ("openrouter_connect_seconds", "Connection setup (DNS, TCP and TLS), when a new connection was opened", SECONDS_BUCKETS),
+    "tokens_per_second": ("openrouter_tokens_per_second", "Completion tokens per second", RATE_BUCKETS),
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (field, model, path) -> Histogram
+_requests = {}  # (model, path, status) -> count
+_retries = {}  # (model, path) -> count
+_recent = {}  # model -> deque of (monotonic time, status, latency, ttft, tokens_per_second)
+_log_queue = queue.SimpleQueue()
+_log_thread = None
+_server = None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation (inf if past the last one)
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+def record(model, path, status, latency, ttft=None, dns=None, connect=None, completion_tokens=None,
+           attempt=0, provider=None, hedge=False):
+    # One attempt on the request path. path names the code path ("chat",
+    # "stream", "stream_async"); attempt > 0 marks a retry
+    tokens_per_second = None
+    if completion_tokens and latency:
+        generation_time = latency - (ttft or 0)
+        if generation_time > 0:
+            tokens_per_second = completion_tokens / generation_time
+    values = {"latency": latency, "ttft": ttft, "dns": dns, "connect": connect, "tokens_per_second": tokens_per_second}
+    with _lock:
+        for field, value in values.items():
+            if value is None:
+                continue
+            key = (field, model, path)
+            if key not in _histograms:
+                _histograms[key] = Histogram(HISTOGRAMS[field][2])
+            _histograms[key].observe(value)
+        status_key = (model, path, str(status))
+        _requests[status_key] = _requests.get(status_key, 0) + 1
+        if attempt:
+            _retries[(model, path)] = _retries.get((model, path), 0) + 1
+        if model not in _recent:
+            _recent[model] = collections.deque(maxlen=RECENT_SIZE)
+        _recent[model].append((time.monotonic(), str(status), latency, ttft, tokens_per_second))
+    if LOG_PATH:
+        _log({
+            "time": time.time(),
+            "model": model,
+            "provider": provider,
+            "path": path,
+            "status": status,
+            "attempt": attempt,
+            "hedge": hedge,
+            "latency": latency,
+            "ttft": ttft,
+            "dns": dns,
+            "connect": connect,
+            "completion_tokens": completion_tokens,
+            "tokens_per_second": tokens_per_second,
+        })
+
+
+def _log(entry):
+    # Appends happen on a writer thread so the client loop never waits on disk
+    global _log_thread
+    _log_queue.put(entry)
+    if _log_thread is None:
+        with _lock:
+            if _log_thread is None:
+                _log_thread = threading.Thread(target=_write_log, name="openrouter-metrics-log", daemon=True)
+                _log_thread.start()
+
+
+def _write_log():
+    while True:
+        entries = [_log_queue.get()]
+        while True:
+            try:
+                entries.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with open(LOG_PATH, "a", encoding="utf-8") as log_file:
+                log_file.writelines(json.dumps(entry) + "\n" for entry in entries)
+        except OSError:
+            pass
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def render_prometheus():
+    # Prometheus text exposition format
+    lines = []
+    with _lock:
+        for field, (name, help_text, buckets) in HISTOGRAMS.items():
+            series = [(key, histogram) for key, histogram in _histograms.items() if key[0] == field]
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (_, model, path), histogram in sorted(series, key=lambda item: item[0][1:]):
+                labels = _labels(model=model, path=path)
+                cumulative = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        if _requests:
+            lines.append("# HELP openrouter_requests_total Request attempts by final status")
+            lines.append("# TYPE openrouter_requests_total counter")
+            for (model, path, status), count in sorted(_requests.items()):
+                lines.append(f"openrouter_requests_total{{{_labels(model=model, path=path, status=status)}}} {count}")
+        if _retries:
+            lines.append("# HELP openrouter_retries_total Retried attempts")
+            lines.append("# TYPE openrouter_retries_total counter")
+            for (model, path), count in sorted(_retries.items()):
+                lines.append(f"openrouter_retries_total{{{_labels(model=model, path=path)}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def recent(model, max_age=RECENT_SECONDS):
+    # The model's latest attempts on any path, oldest first, as
+    # (status, latency, ttft, tokens_per_second); a rolling window for routing
+    cutoff = time.monotonic() - max_age
+    with _lock:
+        entries = list(_recent.get(model, ()))
+    return [entry[1:] for entry in entries if entry[0] >= cutoff]
+
+
+def summary():
+    # One row per model and path for display in the apps
+    rows = []
+    with _lock:
+        for (field, model, path), histogram in sorted(_histograms.items(), key=lambda item: item[0][1:]):
+            if field != "latency":
+                continue
+            ttft = _histograms.get(("ttft", model, path))
+            errors = sum(count for (m, p, status), count in _requests.items()
+                         if m == model and p == path and status != "200")
+            rows.append({
+                "Model": model,
+                "Path": path,
+                "Requests": histogram.count,
+                "Errors": errors,
+                "Retries": _retries.get((model, path), 0),
+                "Mean latency (s)": round(histogram.sum / histogram.count, 3),
+                "p95 latency (s)": histogram.quantile(0.95),
+                "Mean TTFT (s)": round(ttft.sum / ttft.count, 3) if ttft and ttft.count else None,
+            })
+    return rows
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=PORT, host="0.0.0.0"):
+    # Start the /metrics endpoint once per process; later calls are no-ops
+    global _server
+    with _lock:
+        if _server is not None or not port:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError:
+            # Another process (e.g. a second Streamlit app) already serves this port
+            return None
+        threading.Thread(target=_server.serve_forever, name="openrouter-metrics", daemon=True).start()
+        return _server
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+import openrouter_client
+import response_cache
+
+MODELS_PATH = "models.json"
+FILLER_WORDS = "the quick brown fox jumps over a lazy dog while the model keeps talking".split()
+CHUNK_TOKENS = 4  # Tokens per streamed SSE chunk
+CHARS_PER_TOKEN = 4
+PRICE_PER_TOKEN = 0.000001  # Billed cost reported by /generation
+
+
+class MockConfig:
+    # How the stand-in server behaves. Latencies are log-normal around the
+    # given median, so runs with the same seed draw the same distribution
+    def __init__(self, latency=0.3, latency_sigma=0.5, tokens_per_second=100.0, completion_tokens=64,
+                 rate_limit_rate=0.0, retry_after=1.0, error_rate=0.0, seed=0, failing_models=()):
+        self.latency = latency  # Median seconds before the first token
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second  # Generation speed after the first token (0 = instant)
+        self.completion_tokens = completion_tokens  # Per choice
+        self.rate_limit_rate = rate_limit_rate  # Fraction of requests answered with 429
+        self.retry_after = retry_after
+        self.error_rate = error_rate  # Fraction of requests answered with 502
+        self.failing_models = frozenset(failing_models)  # Always answered with 502, like a provider incident
+        self.random = random.Random(seed)
+
+    def first_token_delay(self):
+        if self.latency <= 0:
+            return 0.0
+        return self.random.lognormvariate(math.log(self.latency), self.latency_sigma)
+
+    def token_delay(self, tokens):
+        return tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+
+def recording_key(payload):
+    # Same request hash as the response cache, kept apart for streamed and plain bodies
+    return f"{response_cache.cache_key(payload)}:{'stream' if payload.get('stream') else 'json'}"
+
+
+def load_recordings(path):
+    recordings = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                recordings[entry["key"]] = entry
+    return recordings
+
+
+def prompt_tokens(messages):
+    # Rough count; the mock only needs plausible, deterministic usage
+    tokens = 3
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        tokens += 4 + len(content) // CHARS_PER_TOKEN
+    return tokens
+
+
+def completion_text(tokens, offset=0):
+    return " ".join(FILLER_WORDS[(offset + i) % len(FILLER_WORDS)] for i in range(tokens))
+
+
+def _usage(payload, choices, completion_tokens):
+    return {
+        "prompt_tokens": prompt_tokens(payload.get("messages", [])),
+        "completion_tokens": choices * completion_tokens,
+        "total_tokens": prompt_tokens(payload.get("messages", [])) + choices * completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+
+def _choice_count(payload):
+    # Like OpenRouter, only some providers honour `n`
+    if payload.get("model", "").startswith(openrouter_client.N_SUPPORTED_PREFIXES):
+        return max(1, int(payload.get("n") or 1))
+    return 1
+
+
+async def _chat_completions(request):
+    app = request.app
+    config = app["config"]
+    stats = app["stats"]
+    stats["requests"] += 1
+    payload = await request.json()
+    key = recording_key(payload)
+
+    if key in app["recordings"]:
+        stats["replayed"] += 1
+        entry = app["recordings"][key]
+        await asyncio.sleep(config.first_token_delay())
+        return web.Response(status=entry["status"], body=entry["body"].encode("utf-8"), content_type=entry["content_type"])
+    if app["upstream"]:
+        return await _record(request, payload, key)
+
+    roll = config.random.random()
+    if roll < config.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return web.json_response({"error": {"code": 429, "message": "Rate limit exceeded (mock)"}}, status=429,
+                                 headers={"Retry-After": str(config.retry_after)})
+    if roll < config.rate_limit_rate + config.error_rate or payload.get("model") in config.failing_models:
+        stats["errors"] += 1
+        return web.json_response({"error": {"code": 502, "message": "Provider error (mock)"}}, status=502)
+
+    choices = _choice_count(payload)
+    tokens = min(int(payload.get("max_tokens") or config.completion_tokens), config.completion_tokens)
+    completion_id = f"gen-mock-{uuid.uuid4().hex[:12]}"
+    base = {"id": completion_id, "provider": "Mock", "model": payload.get("model"), "created": int(time.time())}
+    first_token_delay = config.first_token_delay()
+    app["generations"][completion_id] = _usage(payload, choices, tokens)
+
+    if not payload.get("stream"):
+        await asyncio.sleep(first_token_delay + config.token_delay(tokens))
+        return web.json_response(dict(base, object="chat.completion", choices=[
+            {"index": index, "finish_reason": "stop", "message": {"role": "assistant", "content": completion_text(tokens, index)}}
+            for index in range(choices)
+        ], usage=_usage(payload, choices, tokens)))
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    await response.write(b": OPENROUTER PROCESSING\n\n")
+    await asyncio.sleep(first_token_delay)
+    for start in range(0, tokens, CHUNK_TOKENS):
+        count = min(CHUNK_TOKENS, tokens - start)
+        chunk = dict(base, object="chat.completion.chunk", choices=[
+            {"index": index, "delta": {"content": ("" if start == 0 else " ") + completion_text(count, start + index)}}
+            for index in range(choices)
+        ])
+        try:
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        except ConnectionResetError:
+            # The client hung up (e.g. "Stop generating"); stop generating like OpenRouter does
+            stats["disconnected"] += 1
+            app["generations"][completion_id] = _usage(payload, choices, start)
+            return response
+        await asyncio.sleep(config.token_delay(count))
+    if (payload.get("stream_options") or {}).get("include_usage"):
+        chunk = dict(base, object="chat.completion.chunk", choices=[], usage=_usage(payload, choices, tokens))
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def _record(request, payload, key):
+    # Forward to the real API and keep the response for later --replay runs
+    app = request.app
+    headers = {name: value for name, value in request.headers.items() if name.lower() in ("authorization", "http-referer", "x-title")}
+    async with app["client"].post(f"{app['upstream']}/chat/completions", headers=headers, json=payload) as upstream:
+        body = await upstream.text()
+        entry = {"key": key, "status": upstream.status, "content_type": upstream.content_type, "body": body}
+    if upstream.status == 200:
+        app["recordings"][key] = entry
+        with open(app["record_path"], 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    app["stats"]["recorded"] += 1
+    return web.Response(status=entry["status"], body=body.encode("utf-8"), content_type=entry["content_type"])
+
+
+async def _models(request):
+    # Serves models.json with an ETag so the catalog refresher can revalidate
+    body, etag = request.app["models"]
+    request.app["stats"]["models"] += 1
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+
+async def _generation(request):
+    # Billed cost of an earlier synthetic completion, for ledger reconciliation
+    usage = request.app["generations"].get(request.query.get("id"))
+    if usage is None:
+        return web.json_response({"error": {"code": 404, "message": "Generation not found"}}, status=404)
+    return web.json_response({"data": {
+        "id": request.query["id"],
+        "tokens_prompt": usage["prompt_tokens"],
+        "tokens_completion": usage["completion_tokens"],
+        "total_cost": usage["total_tokens"] * PRICE_PER_TOKEN,
+    }})
+
+
+async def _client_context(app):
+    app["client"] = aiohttp.ClientSession() if app["upstream"] else None
+    yield
+    if app["client"] is not None:
+        await app["client"].close()
+
+
+def create_app(config=None, models_path=MODELS_PATH, replay_path=None, record_path=None, upstream=None):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["config"] = config or MockConfig()
+    app["stats"] = {"requests": 0, "rate_limited": 0, "errors": 0, "replayed": 0, "recorded": 0, "models": 0, "disconnected": 0}
+    app["recordings"] = load_recordings(replay_path) if replay_path else {}
+    app["generations"] = {}
+    app["record_path"] = record_path
+    app["upstream"] = upstream.rstrip("/") if upstream else None
+    with open(models_path, 'rb') as f:
+        body = f.read()
+    app["models"] = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+    app.cleanup_ctx.append(_client_context)
+    app.router.add_post("/api/v1/chat/completions", _chat_completions)
+    app.router.add_get("/api/v1/models", _models)
+    app.router.add_get("/api/v1/generation", _generation)
+    return app
+
+
+class MockServer:
+    # Runs the mock on its own loop thread, e.g. inside a benchmark process
+    def __init__(self, app, host="127.0.0.1", port=0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/api/v1"
+
+    @property
+    def stats(self):
+        return self.app["stats"]
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        threading.Thread(target=self._loop.run_forever, name="mock-openrouter", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenRouter API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.3, help="Median seconds to the first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal spread of the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="Generation speed (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=64, help="Tokens generated per choice")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 502")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--failing-model", action="append", default=[], help="Answer every request for this model with 502")
+    parser.add_argument("--models", default=MODELS_PATH, help="Catalog served at /api/v1/models")
+    parser.add_argument("--replay", metavar="JSONL", help="Serve recorded responses for matching requests")
+    parser.add_argument("--record", metavar="JSONL", help="Forward requests to --upstream and append the responses here")
+    parser.add_argument("--upstream", default="https://openrouter.ai/api/v1", help="Real API used when recording")
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.latency_sigma, args.tokens_per_second, args.completion_tokens,
+                        args.rate_limit_rate, args.retry_after, args.error_rate, args.seed, args.failing_model)
+    app = create_app(config, args.models, replay_path=args.replay, record_path=args.record,
+                     upstream=args.upstream if args.record else None)
+    print(f"Point the apps at this server with OPENROUTER_BASE_URL=http://{args.host}:{args.port}/api/v1")
+    web.run_app(app, host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+import prompt_caching
+
+MODELS_PATH = "models.json"
+INDEX_PATH = os.getenv("MODELS_INDEX_PATH", ".models_index.pkl")  # Index of models.json
+FETCHED_INDEX_PATH = os.getenv("MODELS_FETCHED_INDEX_PATH", ".models_fetched_index.pkl")  # Index of the last /models fetch
+INDEX_VERSION = 2
+
+# Pricing fields in the order they are stored in ModelCatalog.pricing
+PRICE_FIELDS = ("prompt", "completion", "request", "image", "input_cache_read", "input_cache_write")
+
+
+class ModelCatalog:
+    # Compiled view of the /models catalog. `models` is a drop-in for the old
+    # models_dict (same keys, pricing already floats) and `pricing` maps each
+    # id to a tuple of per-unit prices in PRICE_FIELDS order
+    def __init__(self, index):
+        self.source = index["source"]
+        self.ids = index["ids"]
+        self.models = index["models"]
+        self.pricing = index["pricing"]
+        self._options = {}
+
+    def __contains__(self, model_id):
+        return model_id in self.models
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, model_id):
+        return self.models.get(model_id)
+
+    def options(self, specified_models):
+        # Specified models that exist first, then the rest in catalog order
+        key = tuple(specified_models)
+        if key not in self._options:
+            specified = [model for model in key if model in self.models]
+            chosen = set(specified)
+            self._options[key] = tuple(specified + [model for model in self.ids if model not in chosen])
+        return list(self._options[key])
+
+
+def _parse_price(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def compile_index(models_data, source):
+    ids = []
+    models = {}
+    pricing = {}
+    for model in models_data['data']:
+        model_id = sys.intern(model['id'])
+        raw_pricing = model.get('pricing') or {}
+        # Cache prices fall back to provider multipliers when the catalog has none
+        prices = tuple(_parse_price(raw_pricing.get(field)) for field in PRICE_FIELDS[:4])
+        prices += prompt_caching.cache_prices(model_id, raw_pricing)
+        ids.append(model_id)
+        models[model_id] = dict(model, id=model_id, pricing=dict(zip(PRICE_FIELDS, prices)))
+        pricing[model_id] = prices
+    return {
+        "version": INDEX_VERSION,
+        "source": source,
+        "ids": tuple(ids),
+        "models": models,
+        "pricing": pricing,
+    }
+
+
+def _read_index(path, source):
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    if not isinstance(index, dict) or index.get("version") != INDEX_VERSION or index.get("source") != source:
+        return None
+    return index
+
+
+def _write_index(path, index):
+    # Write to a temp file and rename so concurrent readers never see a partial index
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_catalog_file(path=MODELS_PATH, index_path=INDEX_PATH):
+    # The index is keyed on the file's mtime and size, so an unchanged
+    # models.json never gets parsed
+    stat = os.stat(path)
+    source = f"file:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    index = _read_index(index_path, source)
+    if index is None:
+        with open(path, 'rb') as f:
+            index = compile_index(json.load(f), source)
+        _write_index(index_path, index)
+    return ModelCatalog(index)
+
+
+def data_source(models_data):
+    # Content hash identifying a fetched catalog
+    encoded = json.dumps(models_data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return f"sha1:{hashlib.sha1(encoded).hexdigest()}"
+
+
+def read_catalog(source, index_path=FETCHED_INDEX_PATH):
+    # Stored catalog for a source, or None if the index holds something else
+    index = _read_index(index_path, source)
+    return ModelCatalog(index) if index is not None else None
+
+
+def catalog_from_data(models_data, index_path=FETCHED_INDEX_PATH):
+    # For catalogs fetched from the API: reuse the stored index when the
+    # content hash matches, otherwise compile and store it
+    source = data_source(models_data)
+    index = _read_index(index_path, source)
+    if index is None:
+        index = compile_index(models_data, source)
+        _write_index(index_path, index)
+    return ModelCatalog(index)
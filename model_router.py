@@ -0,0 +1,164 @@
+import asyncio
+import os
+
+import metrics
+import openrouter_client
+import response_cache
+
+# Router settings (override with environment variables)
+PRICE_WEIGHT = float(os.getenv("MODEL_ROUTER_PRICE_WEIGHT", "0.5"))  # 0 ignores price; 1 trades time for price one to one
+FIRST_TOKEN_TIMEOUT = float(os.getenv("MODEL_ROUTER_FIRST_TOKEN_TIMEOUT", "15"))  # Seconds before a stream fails over
+
+# A typical request, for comparing models' speed and price on the same footing
+TYPICAL_PROMPT_TOKENS = 1000
+TYPICAL_COMPLETION_TOKENS = 300
+
+# Until a model has recent attempts it is assumed to answer a typical request
+# in PRIOR_SECONDS without errors; the prior counts as PRIOR_WEIGHT attempts
+PRIOR_SECONDS = 7.5
+PRIOR_WEIGHT = 3
+
+# Free models are scored as if they cost this fraction of the cheapest paid
+# model in the pool: preferred, but not so much that speed stops mattering
+FREE_PRICE_RATIO = 0.1
+
+# Attempt statuses that say nothing about the model
+NEUTRAL_STATUSES = ("cancelled",)
+
+
+def _typical_seconds(latency, ttft, tokens_per_second):
+    # Time one successful attempt implies for a typical completion
+    if tokens_per_second:
+        return (ttft or 0) + TYPICAL_COMPLETION_TOKENS / tokens_per_second
+    return ttft if ttft is not None else latency
+
+
+def _typical_price(catalog, model):
+    pricing = (catalog.get(model) if catalog else None) or {}
+    pricing = pricing.get('pricing') or {}
+    prompt, completion = pricing.get('prompt'), pricing.get('completion')
+    # Routers like openrouter/auto list -1 prices: the cost depends on the model picked
+    if prompt is None or completion is None or prompt < 0 or completion < 0:
+        return None
+    return prompt * TYPICAL_PROMPT_TOKENS + completion * TYPICAL_COMPLETION_TOKENS
+
+
+def model_stats(model):
+    # Recent speed and error rate of model, shrunk towards the priors while
+    # there are few attempts. Attempts older than metrics.RECENT_SECONDS have
+    # aged out, so a model that failed during an incident is tried again later
+    attempts = [attempt for attempt in metrics.recent(model) if attempt[0] not in NEUTRAL_STATUSES]
+    seconds = [_typical_seconds(latency, ttft, rate) for status, latency, ttft, rate in attempts
+               if status == "200" and latency is not None]
+    errors = sum(1 for attempt in attempts if attempt[0] != "200")
+    return {
+        "attempts": len(attempts),
+        "errors": errors,
+        "error_rate": errors / (len(attempts) + PRIOR_WEIGHT),
+        "seconds": (sum(seconds) + PRIOR_SECONDS * PRIOR_WEIGHT) / (len(seconds) + PRIOR_WEIGHT),
+    }
+
+
+def scores(models, catalog=None):
+    # One row per model, best (lowest score) first. The score is the expected
+    # seconds for a typical answer, inflated by the retries its error rate
+    # implies and by its price relative to the cheapest paid model in the pool
+    prices = {model: _typical_price(catalog, model) for model in models}
+    cheapest = min((price for price in prices.values() if price), default=None)
+    rows = []
+    for model in models:
+        stats = model_stats(model)
+        price_factor = 1.0  # Unpriced, or no paid model to compare with
+        if cheapest and prices[model]:
+            price_factor = (prices[model] / cheapest) ** PRICE_WEIGHT
+        elif cheapest and prices[model] == 0:
+            price_factor = FREE_PRICE_RATIO ** PRICE_WEIGHT
+        expected = stats["seconds"] / max(1 - stats["error_rate"], 0.05)
+        rows.append({"model": model, "score": expected * price_factor, "price": prices[model], **stats})
+    # sorted() is stable: ties keep the pool order
+    return sorted(rows, key=lambda row: row["score"])
+
+
+def rank(models, catalog=None):
+    # The pool's models in the order they should be tried
+    return [row["model"] for row in scores(models, catalog)]
+
+
+def similar_models(catalog, model, count=4, spread=2.0):
+    # model plus up to count - 1 catalog models whose typical request costs
+    # within a factor of spread of it, closest in price first
+    if not model:
+        return []
+    price = _typical_price(catalog, model)
+    if price is None:
+        return [model]
+    candidates = []
+    for other in catalog.ids:
+        other_price = _typical_price(catalog, other)
+        if other != model and other_price is not None and price / spread <= other_price <= price * spread:
+            candidates.append((abs(other_price - price), other))
+    return [model] + [other for _, other in sorted(candidates)[:count - 1]]
+
+
+async def call_async(models, messages, api_key, temperature=None, catalog=None, title=openrouter_client.DEFAULT_TITLE,
+                     cache=response_cache.CACHE_OFF, **params):
+    # openrouter_client.call_openrouter_api_async on the best model in the
+    # pool, failing over down the ranking. Returns (content, usage, model)
+    content, usage, model = "Error: no models to route to", None, None
+    for model in rank(models, catalog):
+        content, usage = await openrouter_client.call_openrouter_api_async(messages, model, api_key, temperature, title=title,
+                                                                           cache=cache, **params)
+        if usage is not None:
+            break
+    return content, usage, model
+
+
+async def _stream_attempt(model, messages, api_key, temperature, title, on_delta, result, params):
+    # One streamed attempt, abandoned if no token arrives within FIRST_TOKEN_TIMEOUT
+    first_token = asyncio.Event()
+
+    def deliver(delta):
+        first_token.set()
+        if on_delta is not None:
+            on_delta(delta)
+
+    attempt = asyncio.ensure_future(openrouter_client.stream_openrouter_api_async(
+        messages, model, api_key, temperature, title, on_delta=deliver, result=result, **params))
+    waiter = asyncio.ensure_future(first_token.wait())
+    try:
+        await asyncio.wait({attempt, waiter}, timeout=FIRST_TOKEN_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        if not attempt.done() and not first_token.is_set():
+            # Recorded as this model's attempt status, so the ranking learns from it
+            result.error = "Error: first token timeout"
+            attempt.cancel()
+        await asyncio.wait({attempt})
+    finally:
+        waiter.cancel()
+        if not attempt.done():
+            # Cancelled from outside (e.g. "Stop generating"): let the attempt record its usage
+            attempt.cancel()
+            await asyncio.wait({attempt})
+
+
+async def stream_async(models, messages, api_key, temperature=None, catalog=None, title=openrouter_client.DEFAULT_TITLE,
+                       on_delta=None, result=None, **params):
+    # openrouter_client.stream_openrouter_api_async on the best model in the
+    # pool, failing over down the ranking while nothing has been streamed.
+    # result.model tells which model answered
+    result = result if result is not None else openrouter_client.StreamResult()
+    result.error = "Error: no models to route to"
+    for model in rank(models, catalog):
+        result.model = model
+        result.error = result.status = result.usage = result.generation_id = result.provider = None
+        await _stream_attempt(model, messages, api_key, temperature, title, on_delta, result, params)
+        if not result.error or result.content:
+            break
+    return result
+
+
+def start_stream(models, messages, api_key, temperature=None, catalog=None, title=openrouter_client.DEFAULT_TITLE,
+                 on_finish=None, **params):
+    # Non-blocking stream_async(), like openrouter_client.start_stream(). The
+    # response cache isn't consulted: the model is only chosen at request time
+    stream = openrouter_client.BackgroundStream(on_finish=on_finish)
+    return stream.start(stream_async(models, messages, api_key, temperature, catalog, title, result=stream, **params))
@@ -0,0 +1,548 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import prompt_caching
+import rate_limiter
+import request_policy
+import response_cache
+import token_estimator
+import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+# Connection settings (override with environment variables)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", "32"))  # Total keep-alive connections
+POOL_PER_HOST = int(os.getenv("OPENROUTER_POOL_PER_HOST", "16"))  # Connections per host
+KEEPALIVE_TIMEOUT = float(os.getenv("OPENROUTER_KEEPALIVE_TIMEOUT", "60"))  # Seconds an idle connection is kept
+
+# Model prefixes whose providers honour the `n` choices parameter on OpenRouter
+N_SUPPORTED_PREFIXES = ("openai/",)
+
+DEFAULT_REFERER = "http://localhost:8000"  # Replace with your actual URL
+DEFAULT_TITLE = "Streamlit OpenRouter App"
+
+# Process-wide state. Streamlit re-executes the page script on every rerun but
+# keeps imported modules, so everything below is shared by all reruns and sessions.
+_lock = threading.Lock()
+_session = None
+_loop = None
+_async_session = None
+_n_unsupported = set()  # Models seen returning fewer choices than requested
+
+
+def build_headers(api_key, title=DEFAULT_TITLE):
+    headers = {
+        "HTTP-Referer": DEFAULT_REFERER,
+        "X-Title": title,
+    }
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+
+def build_payload(messages, model, temperature=None, **params):
+    payload = {
+        "model": model,
+        "messages": prompt_caching.add_cache_breakpoints(messages, model),
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    payload.update(params)
+    return payload
+
+
+def get_session():
+    # Blocking face: one requests.Session with a keep-alive pool
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=max(1, POOL_SIZE // POOL_PER_HOST), pool_maxsize=POOL_PER_HOST)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def get_loop():
+    # aiohttp sessions are bound to the loop they were created on, so async
+    # calls run on one long-lived loop instead of a fresh asyncio.run() loop
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openrouter-client", daemon=True).start()
+            metrics.serve()
+        return _loop
+
+
+def run(coro, timeout=None):
+    # Run a coroutine on the shared client loop and wait for its result
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def _trace_config():
+    # Times DNS lookups and new connections into the dict passed as trace_request_ctx
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_dns_start(session, context, params):
+        context.dns_started = time.perf_counter()
+
+    async def on_dns_end(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx["dns"] = time.perf_counter() - context.dns_started
+
+    async def on_connect_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_connect_end(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx["connect"] = time.perf_counter() - context.connect_started
+
+    trace_config.on_dns_resolvehost_start.append(on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_end)
+    trace_config.on_connection_create_start.append(on_connect_start)
+    trace_config.on_connection_create_end.append(on_connect_end)
+    return trace_config
+
+
+async def get_async_session():
+    global _async_session
+    if asyncio.get_running_loop() is not _loop:
+        raise RuntimeError("Async OpenRouter calls must run on the client loop; use openrouter_client.run()")
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE,
+            limit_per_host=POOL_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=request_policy.TOTAL_TIMEOUT,
+            sock_connect=request_policy.CONNECT_TIMEOUT,
+            sock_read=request_policy.READ_TIMEOUT,
+        )
+        _async_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[_trace_config()])
+    return _async_session
+
+
+def _parse_completion(data):
+    content = data['choices'][0]['message']['content']
+    usage = data.get('usage', {})
+    return content, usage
+
+
+def _parse_choices(data):
+    contents = [choice['message']['content'] for choice in data.get('choices', [])]
+    usage = data.get('usage', {})
+    return contents, usage
+
+
+def supports_n(model):
+    return model.startswith(N_SUPPORTED_PREFIXES) and model not in _n_unsupported
+
+
+def _post_chat(payload, api_key, title, priority=rate_limiter.PRIORITY_INTERACTIVE):
+    # Returns (status, data); data is None unless the request succeeded.
+    # Blocking callers share the async path, so they get the same timeouts,
+    # retries and hedging
+    return run(_post_chat_async(payload, api_key, title, priority))
+
+
+async def _send_chat_async(payload, api_key, title, priority, attempt=0, hedge=False):
+    # One scheduled attempt. Returns (status, data, retry_after); status is a
+    # string for failures that never got an HTTP status
+    scheduler = rate_limiter.scheduler
+    ticket = await scheduler.acquire(api_key, payload["model"], rate_limiter.estimate_tokens(payload), priority)
+    if ticket is None:
+        return "request queue full", None, None
+    status = retry_after = data = None
+    timings = {}
+    started = time.perf_counter()
+    try:
+        session = await get_async_session()
+        async with session.post(f"{OPENROUTER_BASE_URL}/chat/completions", headers=build_headers(api_key, title), json=payload,
+                                trace_request_ctx=timings) as response:
+            status = response.status
+            retry_after = rate_limiter.parse_retry_after(response.headers.get("Retry-After"))
+            if status == 200:
+                data = await response.json()
+                request_policy.record_latency(payload["model"], time.perf_counter() - started)
+                usage_ledger.record(payload["model"], data.get('usage'), data.get('id'), data.get('provider'),
+                                    time.perf_counter() - started, title)
+    except asyncio.TimeoutError:
+        status = "timeout"
+    except aiohttp.ClientError:
+        status = "network error"
+    finally:
+        scheduler.release(ticket, status, retry_after, rate_limiter.usage_tokens(data and data.get('usage')))
+        # A cancelled attempt is the losing side of a hedge
+        metrics.record(payload["model"], "chat", status if status is not None else "cancelled", time.perf_counter() - started,
+                       dns=timings.get("dns"), connect=timings.get("connect"),
+                       completion_tokens=((data or {}).get('usage') or {}).get('completion_tokens'),
+                       attempt=attempt, provider=(data or {}).get('provider'), hedge=hedge)
+    return status, data, retry_after
+
+
+async def _hedged_chat_async(payload, api_key, title, priority, attempt=0):
+    # Sends a duplicate once the first attempt is slower than the model's
+    # recent p95 (within the hedge budget); the first success wins and the
+    # other attempt is cancelled
+    primary = asyncio.ensure_future(_send_chat_async(payload, api_key, title, priority, attempt))
+    delay = request_policy.hedge_delay(payload["model"])
+    if delay is None:
+        return await primary
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done and request_policy.try_spend_hedge():
+            pending.add(asyncio.ensure_future(_send_chat_async(payload, api_key, title, priority, attempt, hedge=True)))
+        result = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result[1] is not None:
+                    return result
+        return result if result is not None else primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _post_chat_async(payload, api_key, title, priority=rate_limiter.PRIORITY_INTERACTIVE):
+    # Retries failures that delivered no completion, with jittered backoff
+    request_policy.count_request()
+    attempt = 0
+    while True:
+        status, data, retry_after = await _hedged_chat_async(payload, api_key, title, priority, attempt)
+        if data is not None or attempt >= request_policy.MAX_RETRIES or not request_policy.is_retryable(status):
+            return status, data
+        await asyncio.sleep(request_policy.retry_delay(attempt, retry_after))
+        attempt += 1
+
+
+def call_openrouter_api(messages, model, api_key, temperature=None, title=DEFAULT_TITLE,
+                        cache=response_cache.CACHE_OFF, cache_variant=0,
+                        priority=rate_limiter.PRIORITY_INTERACTIVE, **params):
+    payload = build_payload(messages, model, temperature, **params)
+
+    def fetch():
+        status, data = _post_chat(payload, api_key, title, priority)
+        if data is not None:
+            return _parse_completion(data)
+        else:
+            return f"Error: {status}", None
+
+    return response_cache.cached_call(payload, cache, fetch, cache_variant, api_key)
+
+
+async def call_openrouter_api_async(messages, model, api_key, temperature=None, title=DEFAULT_TITLE,
+                                    cache=response_cache.CACHE_OFF, cache_variant=0,
+                                    priority=rate_limiter.PRIORITY_INTERACTIVE, **params):
+    payload = build_payload(messages, model, temperature, **params)
+
+    async def fetch():
+        status, data = await _post_chat_async(payload, api_key, title, priority)
+        if data is not None:
+            return _parse_completion(data)
+        else:
+            return f"Error: {status}", None
+
+    return await response_cache.cached_call_async(payload, cache, fetch, cache_variant, api_key)
+
+
+async def call_openrouter_api_choices_async(messages, model, api_key, n, temperature=None, title=DEFAULT_TITLE,
+                                            cache=response_cache.CACHE_OFF,
+                                            priority=rate_limiter.PRIORITY_INTERACTIVE, **params):
+    # One request for n completions. Returns (contents, usage) where usage covers
+    # all choices; contents may be shorter than n if the provider ignores `n`
+    payload = build_payload(messages, model, temperature, n=n, **params)
+
+    async def fetch():
+        status, data = await _post_chat_async(payload, api_key, title, priority)
+        if data is not None:
+            contents, usage = _parse_choices(data)
+            if len(contents) < n:
+                _n_unsupported.add(model)
+            return contents, usage
+        else:
+            if status == 400:
+                _n_unsupported.add(model)
+            return [f"Error: {status}"], None
+
+    return await response_cache.cached_call_async(payload, cache, fetch, api_key=api_key)
+
+
+class StreamResult:
+    # Content, usage, error and timings of a streamed completion, filled in
+    # as the server-sent events are consumed
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.content = ""
+        self.usage = None
+        self.error = None
+        self.status = None
+        self.provider = None
+        self.generation_id = None
+        self.ttft = None  # Seconds from request to first content token
+        self.elapsed = None
+
+    @property
+    def tokens_per_second(self):
+        # Completion tokens over the generation time after the first token
+        if not self.usage or self.ttft is None or not self.elapsed or self.elapsed <= self.ttft:
+            return None
+        return self.usage.get('completion_tokens', 0) / (self.elapsed - self.ttft)
+
+    def _metric_status(self):
+        # HTTP status, or the failure (e.g. "timeout") if the stream broke off
+        return self.error.removeprefix("Error: ") if self.error else self.status
+
+    def _consume_line(self, line):
+        # Returns the content deltas in one SSE line, or None once the stream is over
+        if not line.startswith(b"data:"):
+            # Blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+            return []
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            return None
+        chunk = json.loads(data)
+        if chunk.get('error'):
+            error = chunk['error']
+            self.error = f"Error: {error.get('message', error) if isinstance(error, dict) else error}"
+            return None
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        if chunk.get('provider'):
+            self.provider = chunk['provider']
+        if chunk.get('id'):
+            self.generation_id = chunk['id']
+        deltas = []
+        for choice in chunk.get('choices', []):
+            delta = (choice.get('delta') or {}).get('content')
+            if delta:
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - self.started
+                self.content += delta
+                deltas.append(delta)
+        return deltas
+
+
+async def _stream_attempt_async(payload, api_key, title, priority, on_delta, result, attempt=0):
+    # One scheduled streaming attempt, filling in result. Returns the
+    # response's Retry-After, if any
+    model = payload["model"]
+    scheduler = rate_limiter.scheduler
+    ticket = await scheduler.acquire(api_key, model, rate_limiter.estimate_tokens(payload), priority)
+    if ticket is None:
+        result.error = "Error: request queue full"
+        return None
+    retry_after = None
+    timings = {}
+    started = time.perf_counter()
+    try:
+        session = await get_async_session()
+        async with session.post(f"{OPENROUTER_BASE_URL}/chat/completions", headers=build_headers(api_key, title), json=payload,
+                                trace_request_ctx=timings) as response:
+            result.status = response.status
+            retry_after = rate_limiter.parse_retry_after(response.headers.get("Retry-After"))
+            if response.status != 200:
+                result.error = f"Error: {response.status}"
+                return retry_after
+            async for line in response.content:
+                deltas = result._consume_line(line.rstrip(b"\r\n"))
+                if deltas is None:
+                    break
+                for delta in deltas:
+                    if on_delta is not None:
+                        on_delta(delta)
+    except asyncio.TimeoutError:
+        result.error = "Error: timeout"
+    except aiohttp.ClientError:
+        result.error = "Error: network error"
+    except asyncio.CancelledError:
+        # Stopped by the caller. Dropping the connection ends the generation
+        # upstream, before its usage chunk arrives, so bill the local estimate.
+        # A reason set by the canceller (e.g. a first-token timeout) is kept
+        result.error = result.error or "Error: cancelled"
+        if result.usage is None and result.content:
+            result.usage = _estimated_usage(payload, result.content)
+        raise
+    finally:
+        result.elapsed = time.perf_counter() - result.started
+        scheduler.release(ticket, result.status, retry_after, rate_limiter.usage_tokens(result.usage))
+        usage_ledger.record(model, result.usage, result.generation_id, result.provider, time.perf_counter() - started, title)
+        metrics.record(model, "stream_async", result._metric_status(), time.perf_counter() - started,
+                       ttft=result.ttft, dns=timings.get("dns"), connect=timings.get("connect"),
+                       completion_tokens=(result.usage or {}).get('completion_tokens'),
+                       attempt=attempt, provider=result.provider)
+    return retry_after
+
+
+async def stream_openrouter_api_async(messages, model, api_key, temperature=None, title=DEFAULT_TITLE,
+                                     priority=rate_limiter.PRIORITY_INTERACTIVE, on_delta=None, result=None, **params):
+    # Streams on the client loop, calling on_delta(delta) for each chunk. Pass
+    # your own StreamResult as result to read partial content if the task is
+    # cancelled. Failures are retried only before the first delta was delivered
+    payload = build_payload(messages, model, temperature, stream=True, stream_options={"include_usage": True}, **params)
+    result = result if result is not None else StreamResult()
+    result.started = time.perf_counter()
+    attempt = 0
+    while True:
+        retry_after = await _stream_attempt_async(payload, api_key, title, priority, on_delta, result, attempt)
+        # An HTTP error, or the failure ("timeout", ...) if the request broke off
+        status = result.status if result.status not in (None, 200) else result._metric_status()
+        if (not result.error or result.content or attempt >= request_policy.MAX_RETRIES
+                or not request_policy.is_retryable(status)):
+            return result
+        await asyncio.sleep(request_policy.retry_delay(attempt, retry_after))
+        attempt += 1
+        result.error = result.status = result.usage = result.generation_id = result.provider = None
+
+
+def submit(coro):
+    # Start a coroutine on the client loop without waiting; returns a concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def _estimated_usage(payload, content):
+    # Local token counts for a stream cut off before its usage chunk. The
+    # ledger keeps the generation id, so reconcile() still fetches the billed cost
+    return {
+        "prompt_tokens": token_estimator.count_message_tokens(payload["messages"], payload["model"]),
+        "completion_tokens": token_estimator.count_text_tokens(content, payload["model"]),
+        "estimated": True,
+    }
+
+
+class BackgroundStream(StreamResult):
+    # A streamed completion running on the client loop while the caller carries
+    # on: content grows as deltas arrive and finished is set when it ends.
+    # cancel() aborts the upstream request and keeps the partial content.
+    # on_finish(stream) runs once the request has ended, before finished is set
+    def __init__(self, model=None, on_finish=None):
+        super().__init__()
+        self.model = model  # The model that answered, once known
+        self.on_finish = on_finish
+        self.finished = threading.Event()
+        self.cancelled = False
+        self._task = None
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    async def _run(self, stream):
+        # Set the task before checking cancelled; cancel() does it the other way round
+        self._task = asyncio.current_task()
+        try:
+            if not self.cancelled:
+                await stream
+        except asyncio.CancelledError:
+            pass
+        finally:
+            stream.close()
+            try:
+                if self.on_finish is not None:
+                    # Off the loop: it usually writes to disk
+                    await asyncio.to_thread(self.on_finish, self)
+            except Exception:
+                logger.exception("on_finish failed for the %s stream", self.model)
+            finally:
+                self.finished.set()
+
+    def start(self, stream):
+        # Run the coroutine stream, which fills in this result, on the client loop
+        submit(self._run(stream))
+        return self
+
+    def cancel(self, timeout=5):
+        # Returns once the request has been torn down and its usage recorded
+        self.cancelled = True
+        if self._task is not None:
+            get_loop().call_soon_threadsafe(self._task.cancel)
+        return self.finished.wait(timeout)
+
+
+def start_stream(messages, model, api_key, temperature=None, title=DEFAULT_TITLE,
+                 cache=response_cache.CACHE_OFF, priority=rate_limiter.PRIORITY_INTERACTIVE, on_finish=None, **params):
+    # Non-blocking stream_openrouter_api_async(): returns a BackgroundStream at once
+    payload = build_payload(messages, model, temperature, stream=True, stream_options={"include_usage": True}, **params)
+    key, cached = response_cache.lookup(payload, cache, api_key=api_key)
+    stream = BackgroundStream(model, on_finish)
+    if cached is not None:
+        stream.content, stream.usage = cached
+        stream.ttft = stream.elapsed = time.perf_counter() - stream.started
+        if on_finish is not None:
+            on_finish(stream)
+        stream.finished.set()
+        return stream
+
+    async def stream_and_cache():
+        await stream_openrouter_api_async(messages, model, api_key, temperature, title, priority, result=stream, **params)
+        if key and not stream.error and stream.usage is not None:
+            response_cache.put(key, [stream.content, stream.usage])
+
+    return stream.start(stream_and_cache())
+
+
+def fetch_models_data(api_key, title=DEFAULT_TITLE):
+    # Returns (models_data, error_message)
+    response = get_session().get(f"{OPENROUTER_BASE_URL}/models", headers=build_headers(api_key, title),
+                                 timeout=(request_policy.CONNECT_TIMEOUT, request_policy.READ_TIMEOUT))
+    if response.status_code == 200:
+        return response.json(), None
+    else:
+        return None, f"Failed to fetch models data: {response.status_code}"
+
+
+def fetch_models_data_conditional(api_key, etag=None, last_modified=None, timeout=30, title=DEFAULT_TITLE):
+    # Revalidating fetch. Returns (status, models_data, validators); models_data
+    # is None for 304 Not Modified and for errors (status None on network errors)
+    headers = build_headers(api_key, title)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        response = get_session().get(f"{OPENROUTER_BASE_URL}/models", headers=headers, timeout=(request_policy.CONNECT_TIMEOUT, timeout))
+    except requests.RequestException:
+        return None, None, {}
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    if response.status_code == 200:
+        return response.status_code, response.json(), validators
+    return response.status_code, None, validators
+
+
+async def _close_async_session():
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+
+
+@atexit.register
+def close():
+    global _session
+    if _loop is not None and _loop.is_running():
+        try:
+            run(_close_async_session(), timeout=5)
+        except Exception:
+            pass
+        _loop.call_soon_threadsafe(_loop.stop)
+    if _session is not None:
+        _session.close()
+        _session = None
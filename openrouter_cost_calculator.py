@@ -1,69 +1,158 @@
 import argparse
+import asyncio
 import json
 import os
-import requests
+import time
+import openrouter_client
+import pricing_engine
+import prompt_caching
+import rate_limiter
+import model_catalog
+import response_cache
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Load models data
-with open('models.json', 'r') as f:
-    models_data = json.load(f)['data']
+# Load the compiled models catalog (models.json is only parsed when it changes)
+catalog = model_catalog.load_catalog_file()
+models_dict = catalog.models
+pricing = pricing_engine.for_catalog(catalog)
 
-# Create a dictionary for quick model lookup
-models_dict = {model['id']: model for model in models_data}
+def call_openrouter_api(prompt, model, api_key, cache=response_cache.CACHE_OFF):
+    messages = [{"role": "user", "content": prompt}]
+    content, usage = openrouter_client.call_openrouter_api(messages, model, api_key, title="OpenRouter Cost Calculator", cache=cache)
+    return usage, content
 
-def call_openrouter_api(prompt, model, api_key):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "http://localhost:8000",
-        "X-Title": "OpenRouter Cost Calculator",
-    }
-    
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-    }
-    
-    response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-    
-    if response.status_code == 200:
-        data = response.json()
-        usage = data['usage']
-        content = data['choices'][0]['message']['content']
-        return usage, content
+def read_completed_ids(output_path):
+    # Rows already written without an error are skipped when resuming. Errored
+    # rows are retried, so their old lines (and partial or duplicate ones) are
+    # dropped from the output first
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    stale = False
+    compacted_path = output_path + ".tmp"
+    with open(output_path, 'r') as f, open(compacted_path, 'w') as compacted:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = None  # Partial line from an interrupted run
+            if not isinstance(row, dict) or 'error' in row or row.get('id') in completed:
+                stale = True
+                continue
+            completed.add(row.get('id'))
+            compacted.write(line if line.endswith("\n") else line + "\n")
+    if stale:
+        os.replace(compacted_path, output_path)
     else:
-        return None, f"Error: {response.status_code}"
+        os.remove(compacted_path)
+    return completed
 
-def calculate_cost(usage, model_id):
-    model = models_dict.get(model_id)
-    if not model:
-        return None, None
+def read_batch_rows(input_path, completed):
+    with open(input_path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                row = {"error": f"Invalid JSON: {e}"}
+            if not isinstance(row, dict):
+                row = {"error": "Invalid row: not a JSON object"}
+            row_id = str(row.get('id', line_number))
+            if row_id not in completed:
+                yield row_id, row
 
-    prompt_tokens = usage['prompt_tokens']
-    completion_tokens = usage['completion_tokens']
-    
-    prompt_cost = float(model['pricing']['prompt']) * prompt_tokens
-    completion_cost = float(model['pricing']['completion']) * completion_tokens
-    
-    return prompt_cost, completion_cost
+def price_row(row_id, row, content, usage):
+    result = {"id": row_id, "model": row.get('model')}
+    if usage is None:
+        result["error"] = content
+        return result
+    result["content"] = content
+    result["prompt_tokens"] = usage['prompt_tokens']
+    result["completion_tokens"] = usage['completion_tokens']
+    result["cached_tokens"] = prompt_caching.cached_tokens(usage)
+    prompt_cost, completion_cost = pricing.cost(usage, row['model'])
+    if prompt_cost is not None and completion_cost is not None:
+        result["prompt_cost"] = prompt_cost
+        result["completion_cost"] = completion_cost
+        result["total_cost"] = prompt_cost + completion_cost
+    if usage.get('response_cache_hit'):
+        result["response_cache_hit"] = True
+    return result
+
+async def run_batch_async(input_path, output_path, api_key, concurrency, cache):
+    completed = read_completed_ids(output_path)
+    rows = read_batch_rows(input_path, completed)
+    totals = {"rows": 0, "errors": 0, "cost": 0.0}
+
+    async def worker(out):
+        # Workers pull rows lazily so the input file is never fully in memory
+        for row_id, row in rows:
+            if 'error' in row:
+                content, usage = row['error'], None
+            elif not row.get('prompt') or not row.get('model'):
+                content, usage = "Error: row needs 'prompt' and 'model'", None
+            else:
+                messages = [{"role": "user", "content": row['prompt']}]
+                content, usage = await openrouter_client.call_openrouter_api_async(
+                    messages, row['model'], api_key, title="OpenRouter Cost Calculator", cache=cache,
+                    priority=rate_limiter.PRIORITY_BATCH)
+            result = price_row(row_id, row, content, usage)
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            totals["rows"] += 1
+            if 'error' in result:
+                totals["errors"] += 1
+                print(f"[{row_id}] {result['model']}: {result['error']}")
+            else:
+                totals["cost"] += result.get('total_cost', 0.0)
+                print(f"[{row_id}] {result['model']}: tokens: prompt: {result['prompt_tokens']}, completion: {result['completion_tokens']}, "
+                      f"cost: ${result.get('total_cost', 0.0):.6f}")
+
+    with open(output_path, 'a') as out:
+        await asyncio.gather(*[worker(out) for _ in range(concurrency)])
+    return len(completed), totals
+
+def run_batch(input_path, output_path, api_key, concurrency, cache):
+    started = time.perf_counter()
+    skipped, totals = openrouter_client.run(run_batch_async(input_path, output_path, api_key, concurrency, cache))
+    elapsed = time.perf_counter() - started
+    if skipped:
+        print(f"Resumed: skipped {skipped} rows already in {output_path}")
+    print(f"Rows: {totals['rows']}, errors: {totals['errors']}, elapsed: {elapsed:.1f}s ({totals['rows'] / elapsed if elapsed else 0:.1f} rows/s)")
+    print(f"Cost: total: ${totals['cost']:.6f}")
 
 def main():
     parser = argparse.ArgumentParser(description="Calculate OpenRouter API call cost")
-    parser.add_argument("prompt", help="The prompt to send to the API")
-    parser.add_argument("model", help="The model ID to use")
+    parser.add_argument("prompt", nargs="?", help="The prompt to send to the API")
+    parser.add_argument("model", nargs="?", help="The model ID to use")
+    parser.add_argument("--cache", choices=[response_cache.CACHE_OFF, response_cache.CACHE_DETERMINISTIC, response_cache.CACHE_ALWAYS],
+                        default=response_cache.CACHE_OFF, help="Reuse earlier responses for identical requests")
+    parser.add_argument("--batch", metavar="INPUT_JSONL", help="Price every {\"prompt\", \"model\"} row of a JSONL file")
+    parser.add_argument("--output", metavar="OUTPUT_JSONL", help="Batch results file; rows already in it are skipped (default: INPUT.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Batch requests in flight at once")
     args = parser.parse_args()
 
+    if not args.batch and (not args.prompt or not args.model):
+        parser.error("prompt and model are required unless --batch is given")
+
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         print("Please set the OPENROUTER_API_KEY environment variable")
         return
 
-    usage, content = call_openrouter_api(args.prompt, args.model, api_key)
+    if args.batch:
+        output_path = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        run_batch(args.batch, output_path, api_key, max(1, args.concurrency), args.cache)
+        return
+
+    usage, content = call_openrouter_api(args.prompt, args.model, api_key, args.cache)
     
     if usage:
-        prompt_cost, completion_cost = calculate_cost(usage, args.model)
+        prompt_cost, completion_cost = pricing.cost(usage, args.model)
         if prompt_cost is not None and completion_cost is not None:
             total_cost = prompt_cost + completion_cost
             
@@ -71,8 +160,10 @@ def main():
             print(f"{content}\n")
             
             # Print token counts and costs on two lines
-            print(f"Tokens: prompt: {usage['prompt_tokens']}, completion: {usage['completion_tokens']}")
+            print(f"Tokens: prompt: {usage['prompt_tokens']} ({prompt_caching.cached_tokens(usage)} cached), completion: {usage['completion_tokens']}")
             print(f"Cost: total: ${total_cost:.6f}, prompt: ${prompt_cost:.6f}, completion: ${completion_cost:.6f}")
+            if usage.get('response_cache_hit'):
+                print("(served from the response cache, not billed again)")
         else:
             print(f"Error: Model {args.model} not found in models.json")
     else:
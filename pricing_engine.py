@@ -0,0 +1,92 @@
+import functools
+import itertools
+
+import numpy as np
+
+import model_catalog
+import prompt_caching
+
+# Column of each price in PricingEngine.prices
+PROMPT, COMPLETION, REQUEST, IMAGE, CACHE_READ, CACHE_WRITE = range(len(model_catalog.PRICE_FIELDS))
+
+
+class PricingEngine:
+    # Catalog prices as a (models x PRICE_FIELDS) float64 matrix, so whole
+    # usage tables are priced with array arithmetic instead of per-row lookups
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self.ids = tuple(catalog.ids) if catalog else ()
+        self.index = {model_id: row for row, model_id in enumerate(self.ids)}
+        self.prices = np.array([catalog.pricing[model_id] for model_id in self.ids], dtype=np.float64).reshape(
+            len(self.ids), len(model_catalog.PRICE_FIELDS))
+        # Routers like openrouter/auto list -1 prices: the cost depends on the model picked
+        self.priced = (self.prices >= 0).all(axis=1)
+
+    def cost(self, usage, model_id):
+        # (prompt_cost, completion_cost) of one response, or (None, None) for
+        # unknown models. Like costs(), the per-request fee is in the prompt cost;
+        # choices of one n-choice request (usage from split_usage) share it
+        model = self.catalog.get(model_id) if self.catalog else None
+        if not model or not self.priced[self.index[model_id]]:
+            return None, None
+        request_fee = model['pricing']['request'] / usage.get('shared_choices', 1)
+        prompt_cost = prompt_caching.prompt_cost(usage, model_id, model['pricing']) + request_fee
+        completion_cost = model['pricing']['completion'] * usage['completion_tokens']
+        return prompt_cost, completion_cost
+
+    def model_rows(self, model_ids):
+        # Row of each model id in prices, -1 for models not in the catalog.
+        # One dict lookup per row; sorting the ids with np.unique is ~10x slower
+        model_ids = list(model_ids)
+        return np.fromiter(map(self.index.get, model_ids, itertools.repeat(-1)), dtype=np.int64, count=len(model_ids))
+
+    def costs(self, model_ids, prompt_tokens, completion_tokens, cached_tokens=0, cache_write_tokens=0,
+              requests=0, images=0):
+        # Vectorized cost(): arrays (or scalars) per usage row. Returns
+        # (prompt_cost, completion_cost) arrays, NaN for unknown models.
+        # Per-request and per-image fees are added to the prompt cost
+        rows = self.model_rows(model_ids)
+        known = rows >= 0
+        known[known] = self.priced[rows[known]]
+        prices = self.prices[np.where(known, rows, 0)] if len(self.ids) else np.zeros((len(rows), len(model_catalog.PRICE_FIELDS)))
+        prompt = np.asarray(prompt_tokens, dtype=np.float64)
+        cached = np.minimum(np.asarray(cached_tokens, dtype=np.float64), prompt)
+        written = np.minimum(np.asarray(cache_write_tokens, dtype=np.float64), prompt - cached)
+        prompt_cost = (prices[:, PROMPT] * (prompt - cached - written)
+                       + prices[:, CACHE_READ] * cached
+                       + prices[:, CACHE_WRITE] * written
+                       + prices[:, REQUEST] * np.asarray(requests, dtype=np.float64)
+                       + prices[:, IMAGE] * np.asarray(images, dtype=np.float64))
+        completion_cost = prices[:, COMPLETION] * np.asarray(completion_tokens, dtype=np.float64)
+        prompt_cost[~known] = np.nan
+        completion_cost[~known] = np.nan
+        return prompt_cost, completion_cost
+
+    def reprice(self, prompt_tokens, completion_tokens, cached_tokens=0, cache_write_tokens=0, requests=None, models=None):
+        # What a workload would have cost on each model (all catalog models by
+        # default), cheapest first. Cost is linear in the token counts, so the
+        # workload is summed once and priced with a single matrix-vector product;
+        # cached and cache-write tokens are split off as in costs() and assumed
+        # to stay cached (and written) on the other model
+        prompt = np.asarray(prompt_tokens, dtype=np.float64)
+        cached = np.minimum(np.asarray(cached_tokens, dtype=np.float64), prompt)
+        written = np.minimum(np.asarray(cache_write_tokens, dtype=np.float64), prompt - cached)
+        totals = np.array([
+            (prompt - cached - written).sum(),
+            np.broadcast_to(cached, prompt.shape).sum(),
+            np.broadcast_to(written, prompt.shape).sum(),
+            np.asarray(completion_tokens, dtype=np.float64).sum(),
+            prompt.size if requests is None else requests,
+        ])
+        rows = np.arange(len(self.ids)) if models is None else self.model_rows(models)
+        rows = rows[rows >= 0]
+        rows = rows[self.priced[rows]]
+        totals_by_model = self.prices[rows][:, [PROMPT, CACHE_READ, CACHE_WRITE, COMPLETION, REQUEST]] @ totals
+        order = np.argsort(totals_by_model, kind="stable")
+        return [(self.ids[rows[i]], float(totals_by_model[i])) for i in order]
+
+
+@functools.lru_cache(maxsize=4)
+def for_catalog(catalog):
+    # One engine per catalog object; a refreshed catalog gets a new engine
+    return PricingEngine(catalog)
@@ -0,0 +1,103 @@
+import os
+
+# Mark stable prompt prefixes with provider cache hints (set PROMPT_CACHING=0 to disable)
+ENABLED = os.getenv("PROMPT_CACHING", "1") != "0"
+
+# Models that need explicit cache_control breakpoints. Other providers
+# (OpenAI, DeepSeek, ...) cache long prefixes automatically.
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+
+# Prefixes shorter than this are below every provider's minimum cacheable size
+MIN_CACHE_CHARS = 4000
+
+# Cached-read and cache-write price as a multiple of the prompt price, used
+# when the catalog has no input_cache_read / input_cache_write pricing
+CACHE_READ_MULTIPLIERS = {
+    "anthropic/": 0.1,
+    "openai/": 0.5,
+    "deepseek/": 0.1,
+    "google/": 0.25,
+}
+CACHE_WRITE_MULTIPLIERS = {
+    "anthropic/": 1.25,
+}
+
+
+def supports_cache_control(model):
+    return bool(model) and model.startswith(CACHE_CONTROL_PREFIXES)
+
+
+def _multiplier(model_id, multipliers):
+    for prefix, multiplier in multipliers.items():
+        if model_id.startswith(prefix):
+            return multiplier
+    return 1.0
+
+
+def cache_prices(model_id, pricing):
+    # (read, write) price per cached prompt token from a raw catalog pricing dict
+    prompt_price = float(pricing.get('prompt') or 0)
+    read = pricing.get('input_cache_read')
+    write = pricing.get('input_cache_write')
+    read = float(read) if read not in (None, "") else prompt_price * _multiplier(model_id, CACHE_READ_MULTIPLIERS)
+    write = float(write) if write not in (None, "") else prompt_price * _multiplier(model_id, CACHE_WRITE_MULTIPLIERS)
+    return read, write
+
+
+def _with_breakpoint(message):
+    content = message.get("content")
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    elif isinstance(content, list) and content:
+        content = [dict(part) for part in content]
+    else:
+        return message
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return dict(message, content=content)
+
+
+def _text_length(message):
+    content = message.get("content")
+    if isinstance(content, str):
+        return len(content)
+    return sum(len(part.get("text", "")) for part in content or [] if isinstance(part, dict))
+
+
+def add_cache_breakpoints(messages, model):
+    # Breakpoints go after the system prompt and after the conversation prefix
+    # (everything before the newest message). Returns a new list; the caller's
+    # messages are not modified
+    if not ENABLED or not supports_cache_control(model) or len(messages) < 2:
+        return messages
+    marked = list(messages)
+    breakpoints = set()
+    if marked[0].get("role") == "system" and _text_length(marked[0]) >= MIN_CACHE_CHARS:
+        breakpoints.add(0)
+    if sum(_text_length(message) for message in marked[:-1]) >= MIN_CACHE_CHARS:
+        breakpoints.add(len(marked) - 2)
+    for index in breakpoints:
+        marked[index] = _with_breakpoint(marked[index])
+    return marked
+
+
+def cached_tokens(usage):
+    # Prompt tokens served from the provider's cache, as reported in usage
+    details = (usage or {}).get('prompt_tokens_details') or {}
+    return details.get('cached_tokens') or 0
+
+
+def cache_write_tokens(usage):
+    details = (usage or {}).get('prompt_tokens_details') or {}
+    return details.get('cache_write_tokens') or 0
+
+
+def prompt_cost(usage, model_id, pricing):
+    # Prompt cost with cached reads (and writes, when reported) at their own rates.
+    # pricing is a compiled catalog pricing dict (floats)
+    prompt_tokens = usage['prompt_tokens']
+    cached = min(cached_tokens(usage), prompt_tokens)
+    written = min(cache_write_tokens(usage), prompt_tokens - cached)
+    uncached = prompt_tokens - cached - written
+    return (pricing['prompt'] * uncached
+            + pricing.get('input_cache_read', pricing['prompt']) * cached
+            + pricing.get('input_cache_write', pricing['prompt']) * written)
@@ -0,0 +1,97 @@
+import asyncio
+
+import latex_delimiters
+import openrouter_client
+import prompt_caching
+import response_cache
+
+# Generation logic of the prompt editor (app.py), shared with the HTTP gateway.
+# Coroutines here run on the client loop (openrouter_client.run / submit)
+
+
+def build_messages(system_prompt, prompt):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+async def call_openrouter_api(system_prompt, prompt, model, temperature, api_key, variant=0, cache=response_cache.CACHE_OFF,
+                              title=openrouter_client.DEFAULT_TITLE):
+    messages = build_messages(system_prompt, prompt)
+    return await openrouter_client.call_openrouter_api_async(messages, model, api_key, temperature, title=title, cache=cache,
+                                                             cache_variant=variant)
+
+
+def distribute_tokens(total, weights):
+    # Integer shares of total proportional to weights (largest remainder)
+    weight_sum = sum(weights)
+    exact = [total * weight / weight_sum for weight in weights]
+    shares = [int(share) for share in exact]
+    order = sorted(range(len(weights)), key=lambda i: exact[i] - shares[i], reverse=True)
+    for i in order[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def split_usage(usage, contents):
+    # One n-choice request bills the prompt once, so prompt tokens are divided
+    # evenly and completion tokens in proportion to each choice's length
+    prompt_shares = distribute_tokens(usage['prompt_tokens'], [1] * len(contents))
+    cached_shares = distribute_tokens(prompt_caching.cached_tokens(usage), [1] * len(contents))
+    completion_shares = distribute_tokens(usage['completion_tokens'], [len(content) or 1 for content in contents])
+    return [
+        {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "shared_choices": len(contents),
+        }
+        for prompt_tokens, cached_tokens, completion_tokens in zip(prompt_shares, cached_shares, completion_shares)
+    ]
+
+
+async def get_responses_async(system_prompt, prompt, num_responses, model, temperature, api_key, cache=response_cache.CACHE_OFF,
+                              title=openrouter_client.DEFAULT_TITLE):
+    # num_responses (content, usage) pairs with LaTeX delimiters converted;
+    # usage is None for responses that failed (content is then the error)
+    results = []
+    # Ask for every variant in one request when the model supports `n`
+    if num_responses > 1 and openrouter_client.supports_n(model):
+        messages = build_messages(system_prompt, prompt)
+        contents, usage = await openrouter_client.call_openrouter_api_choices_async(messages, model, api_key, num_responses, temperature,
+                                                                                   title=title, cache=cache)
+        if usage is not None and contents:
+            contents = contents[:num_responses]
+            shares = split_usage(usage, contents)
+            if usage.get('response_cache_hit'):
+                shares = [dict(share, response_cache_hit=True) for share in shares]
+            results = list(zip(contents, shares))
+    # Fan out one request per missing variant
+    tasks = [call_openrouter_api(system_prompt, prompt, model, temperature, api_key, variant, cache, title)
+             for variant in range(len(results), num_responses)]
+    results += await asyncio.gather(*tasks)
+    return [(latex_delimiters.convert(content), usage) for content, usage in results]
+
+
+async def get_routed_responses_async(system_prompt, prompt, num_responses, models, temperature, api_key,
+                                     cache=response_cache.CACHE_OFF, title=openrouter_client.DEFAULT_TITLE):
+    # get_responses_async on the first of models (best first, e.g. from
+    # model_router.rank) that doesn't fail outright. Returns (model, responses)
+    model, responses = None, []
+    for model in models:
+        responses = await get_responses_async(system_prompt, prompt, num_responses, model, temperature, api_key, cache, title)
+        if any(usage is not None for _, usage in responses):
+            break
+    return model, responses
+
+
+def total_cost(pricing, usage, model):
+    # Prompt plus completion cost of one response, or None if it can't be priced
+    if not usage:
+        return None
+    prompt_cost, completion_cost = pricing.cost(usage, model)
+    if prompt_cost is None or completion_cost is None:
+        return None
+    return prompt_cost + completion_cost
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import time
+
+import token_estimator
+
+# Scheduler settings (override with environment variables; 0 disables a limit)
+KEY_RPM = float(os.getenv("OPENROUTER_KEY_RPM", "0"))  # Requests per minute per API key
+KEY_TPM = float(os.getenv("OPENROUTER_KEY_TPM", "0"))  # Estimated tokens per minute per API key
+MODEL_RPM = float(os.getenv("OPENROUTER_MODEL_RPM", "0"))  # Requests per minute per key and model
+MODEL_TPM = float(os.getenv("OPENROUTER_MODEL_TPM", "0"))  # Estimated tokens per minute per key and model
+FREE_MODEL_RPM = float(os.getenv("OPENROUTER_FREE_MODEL_RPM", "20"))  # OpenRouter's limit for ":free" models
+INITIAL_CONCURRENCY = float(os.getenv("OPENROUTER_CONCURRENCY", "8"))
+MAX_CONCURRENCY = float(os.getenv("OPENROUTER_MAX_CONCURRENCY", "64"))
+QUEUE_SIZE = int(os.getenv("OPENROUTER_QUEUE_SIZE", "1000"))  # Waiting requests before new ones are refused
+DEFAULT_RETRY_AFTER = 2.0  # Seconds to pause a scope after a 429 without Retry-After
+
+# Lower numbers are served first. The scheduler is per process, so priority
+# only orders requests made by the same process: the cost calculator's batch
+# mode runs in its own process and doesn't hold back the apps' chat turns
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Requests bigger than the whole bucket go through once it is full
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        # May go negative when actual usage turns out higher than estimated
+        self.tokens -= amount
+
+
+class AIMDLimit:
+    # Additive increase (about +1 per window of successes), multiplicative
+    # decrease on every 429
+    def __init__(self, initial, maximum):
+        self.limit = initial
+        self.maximum = maximum
+        self.active = 0
+
+    def has_room(self):
+        return self.active < int(self.limit)
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttled(self):
+        self.limit = max(1.0, self.limit / 2)
+
+
+class Ticket:
+    def __init__(self, scopes, estimated_tokens):
+        self.scopes = scopes
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+
+
+class Scheduler:
+    # Lives on the openrouter_client loop: all methods must be called from it
+    def __init__(self):
+        self._buckets = {}  # scope -> (request bucket or None, token bucket or None)
+        self._paused_until = {}  # scope -> monotonic time
+        self._limits = {}  # api key scope -> AIMDLimit
+        self._waiting = []  # sorted [(priority, seq, future, key_scope, scopes, tokens)]
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _bucket(self, scope, rpm, tpm):
+        if scope not in self._buckets:
+            self._buckets[scope] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+        return self._buckets[scope]
+
+    def _limit(self, key_scope):
+        if key_scope not in self._limits:
+            self._limits[key_scope] = AIMDLimit(INITIAL_CONCURRENCY, MAX_CONCURRENCY)
+        return self._limits[key_scope]
+
+    def _wait_time(self, scopes, tokens, now):
+        wait = 0.0
+        for scope in scopes:
+            wait = max(wait, self._paused_until.get(scope, 0) - now)
+            requests_bucket, tokens_bucket = self._buckets[scope]
+            if requests_bucket:
+                wait = max(wait, requests_bucket.wait_time(1, now))
+            if tokens_bucket:
+                wait = max(wait, tokens_bucket.wait_time(tokens, now))
+        return wait
+
+    def _pump(self):
+        # Grant waiting requests in priority order; a request whose key or
+        # model is saturated doesn't block others behind it
+        self._timer = None
+        now = time.monotonic()
+        next_wake = None
+        for entry in list(self._waiting):
+            priority, seq, future, key_scope, scopes, tokens = entry
+            if future.done():
+                self._waiting.remove(entry)
+                continue
+            limit = self._limit(key_scope)
+            if not limit.has_room():
+                continue
+            wait = self._wait_time(scopes, tokens, now)
+            if wait > 0:
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+                continue
+            for scope in scopes:
+                requests_bucket, tokens_bucket = self._buckets[scope]
+                if requests_bucket:
+                    requests_bucket.take(1)
+                if tokens_bucket:
+                    tokens_bucket.take(tokens)
+            limit.active += 1
+            self._waiting.remove(entry)
+            future.set_result(Ticket(scopes, tokens))
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._pump)
+
+    def _schedule_pump(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_soon(self._pump)
+
+    async def acquire(self, api_key, model, estimated_tokens, priority=PRIORITY_INTERACTIVE):
+        # Returns a Ticket, or None if the wait queue is full
+        if len(self._waiting) >= QUEUE_SIZE:
+            return None
+        key_scope = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        model_scope = (key_scope, model)
+        model_rpm = MODEL_RPM or (FREE_MODEL_RPM if model.endswith(":free") else 0)
+        self._bucket(key_scope, KEY_RPM, KEY_TPM)
+        self._bucket(model_scope, model_rpm, MODEL_TPM)
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future, key_scope, (key_scope, model_scope), estimated_tokens)
+        self._waiting.append(entry)
+        self._waiting.sort(key=lambda waiting: waiting[:2])
+        self._schedule_pump()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result(), None)
+            raise
+
+    def release(self, ticket, status, retry_after=None, actual_tokens=None):
+        key_scope = ticket.scopes[0]
+        limit = self._limit(key_scope)
+        limit.active -= 1
+        if status == 429:
+            limit.on_throttled()
+            pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+            for scope in ticket.scopes:
+                self._paused_until[scope] = max(self._paused_until.get(scope, 0), time.monotonic() + pause)
+        elif isinstance(status, int) and status < 500:
+            # "timeout" and "network error" say nothing about the rate limit
+            limit.on_success()
+        if actual_tokens is not None and actual_tokens != ticket.estimated_tokens:
+            # Settle the token buckets with what the request really used
+            for scope in ticket.scopes:
+                tokens_bucket = self._buckets[scope][1]
+                if tokens_bucket:
+                    tokens_bucket.take(actual_tokens - ticket.estimated_tokens)
+        self._schedule_pump()
+
+    def stats(self):
+        return {
+            "waiting": len(self._waiting),
+            "limits": {scope: (limit.active, round(limit.limit, 2)) for scope, limit in self._limits.items()},
+        }
+
+
+def estimate_tokens(payload):
+    # Prompt plus requested completion tokens; only computed when a TPM limit is set
+    if not (KEY_TPM or MODEL_TPM):
+        return 0
+    prompt_tokens = token_estimator.count_message_tokens(payload.get("messages", []), payload.get("model"))
+    return prompt_tokens + payload.get("max_tokens", 256) * payload.get("n", 1)
+
+
+def usage_tokens(usage):
+    if not usage:
+        return None
+    return usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+scheduler = Scheduler()
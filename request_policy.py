@@ -0,0 +1,67 @@
+import os
+import random
+from collections import defaultdict, deque
+
+# Timeout, retry and hedging settings (override with environment variables)
+CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "10"))  # Seconds to open a connection
+READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "120"))  # Seconds to wait for the next bytes
+TOTAL_TIMEOUT = float(os.getenv("OPENROUTER_TOTAL_TIMEOUT", "600"))  # Seconds for a whole request
+MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("OPENROUTER_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", "8"))
+HEDGE_ENABLED = os.getenv("OPENROUTER_HEDGE", "0") == "1"
+HEDGE_BUDGET = float(os.getenv("OPENROUTER_HEDGE_BUDGET", "0.05"))  # Max hedged requests as a fraction of all requests
+HEDGE_QUANTILE = 0.95  # Hedge once a request is slower than this quantile of recent ones
+HEDGE_MIN_SAMPLES = 20  # Recent latencies needed before a model is hedged
+
+# Failures where no completion was delivered, so trying again can't double-bill
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504, "timeout", "network error"}
+
+LATENCY_WINDOW = 200  # Recent successful latencies kept per model
+
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+_hedge_counts = {"requests": 0, "hedges": 0}
+
+
+def is_retryable(status):
+    return status in RETRYABLE_STATUSES
+
+
+def retry_delay(attempt, retry_after=None):
+    # Full-jitter exponential backoff, but never sooner than the server asked
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def record_latency(model, seconds):
+    _latencies[model].append(seconds)
+
+
+def latency_quantile(model, quantile):
+    samples = _latencies.get(model)
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def hedge_delay(model):
+    # Seconds to wait before sending a duplicate, or None to not hedge
+    if not HEDGE_ENABLED or len(_latencies.get(model, ())) < HEDGE_MIN_SAMPLES:
+        return None
+    return latency_quantile(model, HEDGE_QUANTILE)
+
+
+def count_request():
+    # Once per logical request, not per retry, so hedges get their full budget
+    _hedge_counts["requests"] += 1
+
+
+def try_spend_hedge():
+    # Hedges are capped at HEDGE_BUDGET of all requests to bound the extra spend
+    if _hedge_counts["hedges"] + 1 > HEDGE_BUDGET * _hedge_counts["requests"]:
+        return False
+    _hedge_counts["hedges"] += 1
+    return True
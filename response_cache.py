@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cache settings (override with environment variables)
+CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".response_cache.sqlite")
+MEMORY_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))  # Entries kept in the in-memory LRU
+TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # Seconds before an entry expires
+SHARED = os.getenv("RESPONSE_CACHE_SHARED", "0") == "1"  # Reuse responses across API keys (only the first key is billed)
+
+# Cache modes accepted by the openrouter_client call functions
+CACHE_OFF = "off"
+CACHE_DETERMINISTIC = "deterministic"  # Only reuse temperature 0 responses
+CACHE_ALWAYS = "always"  # Also reuse sampled (temperature > 0) responses
+
+# Payload fields that change the transport but not the completion
+TRANSPORT_FIELDS = ("stream", "stream_options")
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # key -> (expires, value)
+_inflight = {}  # key -> concurrent.futures.Future of the request being made
+_db = None
+_puts = 0
+
+
+def cache_key(payload, variant=0, api_key=None):
+    # Canonical hash of the request; variant tells apart deliberate repeats
+    # of the same payload (e.g. several sampled responses in the prompt editor).
+    # Entries are per API key unless SHARED, so one caller's paid completion
+    # isn't served to another
+    canonical = {key: value for key, value in payload.items() if key not in TRANSPORT_FIELDS}
+    if variant:
+        canonical["_variant"] = variant
+    if api_key and not SHARED:
+        canonical["_owner"] = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def mode_for(enabled, include_sampled=False):
+    # Map the UI toggles to a cache mode
+    if not enabled:
+        return CACHE_OFF
+    return CACHE_ALWAYS if include_sampled else CACHE_DETERMINISTIC
+
+
+def is_cacheable(payload, mode):
+    if mode == CACHE_ALWAYS:
+        return True
+    if mode == CACHE_DETERMINISTIC:
+        # The API samples at temperature 1 when none is given
+        return payload.get("temperature", 1) == 0
+    return False
+
+
+def _get_db():
+    # Called with _lock held. Falls back to memory only if the file can't be used
+    global _db
+    if _db is None:
+        try:
+            _db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+            _db.execute("PRAGMA journal_mode=WAL")
+            _db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            _db.commit()
+        except sqlite3.Error:
+            _db = False
+    return _db
+
+
+def _remember(key, expires, value):
+    _memory[key] = (expires, value)
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+
+
+def get(key):
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _memory.move_to_end(key)
+                return entry[1]
+            del _memory[key]
+        db = _get_db()
+        if not db:
+            return None
+        try:
+            row = db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or row[1] <= now:
+            return None
+        value = json.loads(row[0])
+        _remember(key, row[1], value)
+        return value
+
+
+def put(key, value):
+    global _puts
+    expires = time.time() + TTL
+    with _lock:
+        _remember(key, expires, value)
+        db = _get_db()
+        if not db:
+            return
+        try:
+            db.execute("INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), expires))
+            _puts += 1
+            if _puts % 100 == 0:
+                db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+            db.commit()
+        except sqlite3.Error:
+            pass
+
+
+def clear():
+    with _lock:
+        _memory.clear()
+        db = _get_db()
+        if db:
+            db.execute("DELETE FROM responses")
+            db.commit()
+
+
+def _claim(key):
+    # The first caller for a key makes the request; identical concurrent
+    # callers get its future and wait for the same result
+    with _lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = concurrent.futures.Future()
+        _inflight[key] = future
+        return future, True
+
+
+def _settle(key, future, result=None, error=None):
+    with _lock:
+        _inflight.pop(key, None)
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _mark_hit(result):
+    # Results are (content, usage); flag usage so callers can show nothing was billed
+    content, usage = result
+    if usage is None:
+        return content, usage
+    return content, dict(usage, response_cache_hit=True)
+
+
+def lookup(payload, mode, variant=0, api_key=None):
+    # For callers that can't wrap the request in cached_call (streams): returns
+    # (key, cached_result); key is None when the payload must not be cached
+    if not is_cacheable(payload, mode):
+        return None, None
+    key = cache_key(payload, variant, api_key)
+    cached = get(key)
+    return key, (_mark_hit(cached) if cached is not None else None)
+
+
+def cached_call(payload, mode, fetch, variant=0, api_key=None):
+    # fetch() makes the request and returns (content, usage); usage None means failure
+    if not is_cacheable(payload, mode):
+        return fetch()
+    key = cache_key(payload, variant, api_key)
+    cached = get(key)
+    if cached is not None:
+        return _mark_hit(cached)
+    future, owner = _claim(key)
+    if not owner:
+        return _mark_hit(future.result())
+    try:
+        result = fetch()
+    except BaseException as error:
+        _settle(key, future, error=error)
+        raise
+    if result[1] is not None:
+        put(key, list(result))
+    _settle(key, future, result=result)
+    return result
+
+
+async def cached_call_async(payload, mode, fetch, variant=0, api_key=None):
+    # Same as cached_call for a coroutine function fetch
+    if not is_cacheable(payload, mode):
+        return await fetch()
+    key = cache_key(payload, variant, api_key)
+    cached = get(key)
+    if cached is not None:
+        return _mark_hit(cached)
+    future, owner = _claim(key)
+    if not owner:
+        return _mark_hit(await asyncio.wrap_future(future))
+    try:
+        result = await fetch()
+    except BaseException as error:
+        _settle(key, future, error=error)
+        raise
+    if result[1] is not None:
+        put(key, list(result))
+    _settle(key, future, result=result)
+    return result
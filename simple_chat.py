@@ -1,6 +1,7 @@
 import streamlit as st
-import requests
 import os
+import openrouter_client
+import transcript
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -51,47 +52,33 @@ def main():
     if not api_key:
         api_key = os.getenv("OPENROUTER_API_KEY")
 
-    # Chat UI
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = []
+    # Chat UI; history lives in the conversation store and can be resumed by id
+    conversation = transcript.conversation_picker("simple_chat")
 
-    # Display previous chat messages
-    for message in st.session_state["messages"]:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+    # Display recent chat messages
+    transcript.render(conversation)
 
     # User input
     if api_key:
         user_input = st.chat_input("You:")
         if user_input:
             # Append user message
-            st.session_state["messages"].append({"role": "user", "content": user_input})
+            conversation.append({"role": "user", "content": user_input})
             with st.chat_message("user"):
                 st.write(user_input)
 
-            # Set headers for OpenRouter API
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-
-            # Define the request payload
-            messages = [{"role": "system", "content": system_prompt}] + st.session_state["messages"]
-            payload = {
-                "model": model,
-                "messages": messages,
-                "max_tokens": 150
-            }
+            # Define the request messages
+            messages = [{"role": "system", "content": system_prompt}] + conversation[:]
 
             try:
                 # Call the OpenRouter API
-                response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                bot_response = data['choices'][0]['message']['content'].strip()
+                content, usage = openrouter_client.call_openrouter_api(messages, model, api_key, max_tokens=150)
+                if usage is None:
+                    raise RuntimeError(content)
+                bot_response = content.strip()
 
                 # Append LLM response
-                st.session_state["messages"].append({"role": "assistant", "content": bot_response})
+                conversation.append({"role": "assistant", "content": bot_response})
                 with st.chat_message("assistant"):
                     st.write(bot_response)
             except Exception as e:
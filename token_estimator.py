@@ -0,0 +1,139 @@
+import re
+import threading
+import time
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to the character heuristic below
+    tiktoken = None
+
+# Rough size of each tokenizer family relative to cl100k_base, measured on
+# English prose. Only GPT models are counted exactly.
+FAMILY_RATIOS = {
+    "GPT": 1.0,
+    "Claude": 1.1,
+    "Llama3": 1.0,
+    "Llama2": 1.2,
+    "Mistral": 1.15,
+    "Gemini": 0.95,
+    "PaLM": 0.95,
+    "Qwen": 1.0,
+    "Cohere": 1.05,
+    "Yi": 1.1,
+}
+DEFAULT_RATIO = 1.1
+CHARS_PER_TOKEN = 4.0  # Used when tiktoken isn't installed (or its encoding isn't loaded yet)
+ENCODING_RETRY_AFTER = 60.0  # Seconds before a failed encoding load is tried again
+
+# Chat formatting overhead (role markers etc.) per message and per request
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REQUEST = 3
+
+# Paragraph boundaries; tokens almost never merge across a blank line, so
+# paragraphs can be counted (and cached) independently
+PARAGRAPH_SPLIT = re.compile(r"(?<=\n\n)")
+
+O200K_MODELS = ("openai/gpt-4o", "openai/o1", "openai/o3", "openai/chatgpt-4o")
+
+
+def tokenizer_family(model_info):
+    if not model_info:
+        return None
+    return (model_info.get('architecture') or {}).get('tokenizer')
+
+
+_encodings = {}  # name -> loaded tiktoken encoding
+_encoding_attempts = {}  # name -> time.monotonic() of the last load started
+_encoding_lock = threading.Lock()
+
+
+def _load_encoding(name):
+    try:
+        _encodings[name] = tiktoken.get_encoding(name)
+    except Exception:  # Encodings are downloaded on first use and may be unavailable offline
+        pass
+
+
+def _get_encoding(name):
+    # The encoding, or None (use the heuristic) until it has loaded. Loading
+    # may download it, so it happens in a background thread instead of a
+    # Streamlit rerun, and a failed load is tried again after ENCODING_RETRY_AFTER
+    encoding = _encodings.get(name)
+    if encoding is not None or tiktoken is None:
+        return encoding
+    with _encoding_lock:
+        started = _encoding_attempts.get(name)
+        if started is not None and time.monotonic() - started < ENCODING_RETRY_AFTER:
+            return None
+        _encoding_attempts[name] = time.monotonic()
+    threading.Thread(target=_load_encoding, args=(name,), name=f"tiktoken-{name}", daemon=True).start()
+    return None
+
+
+def _encoding_name(model_id, family):
+    if family == "GPT" and model_id and model_id.startswith(O200K_MODELS):
+        return "o200k_base"
+    return "cl100k_base"
+
+
+@lru_cache(maxsize=8192)
+def _count_chunk(chunk, encoding_name, exact):
+    if not exact:
+        return int(len(chunk) / CHARS_PER_TOKEN + 0.5)
+    return len(_encodings[encoding_name].encode(chunk, disallowed_special=()))
+
+
+@lru_cache(maxsize=1024)
+def _count_text(text, encoding_name, family, exact):
+    tokens = sum(_count_chunk(chunk, encoding_name, exact) for chunk in PARAGRAPH_SPLIT.split(text))
+    if family == "GPT" and exact:
+        return tokens
+    return int(tokens * FAMILY_RATIOS.get(family, DEFAULT_RATIO) + 0.5)
+
+
+def count_text_tokens(text, model_id=None, family=None):
+    # Cached per text, and per paragraph inside it, so editing one paragraph
+    # of a long prompt only re-tokenizes that paragraph. Heuristic counts are
+    # cached apart from exact ones, so they are replaced once the encoding loads
+    if not text:
+        return 0
+    encoding_name = _encoding_name(model_id, family)
+    return _count_text(text, encoding_name, family, _get_encoding(encoding_name) is not None)
+
+
+def message_text(message):
+    # Content as text, also for content-part lists (e.g. with cache_control)
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def count_message_tokens(messages, model_id=None, family=None):
+    # Each message is cached separately, so a growing chat only counts new turns
+    total = TOKENS_PER_REQUEST
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_text_tokens(message_text(message), model_id, family)
+    return total
+
+
+def estimate_request(messages, model_id, model_info):
+    # Returns prompt tokens, estimated prompt cost (None if unpriced) and the
+    # fraction of the context window the prompt fills (None if unknown)
+    family = tokenizer_family(model_info)
+    prompt_tokens = count_message_tokens(messages, model_id, family)
+    prompt_cost = None
+    context_fill = None
+    if model_info:
+        prompt_cost = float((model_info.get('pricing') or {}).get('prompt', 0)) * prompt_tokens
+        context_length = model_info.get('context_length')
+        if context_length:
+            context_fill = prompt_tokens / context_length
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_cost": prompt_cost,
+        "context_length": (model_info or {}).get('context_length'),
+        "context_fill": context_fill,
+        "family": family,
+    }
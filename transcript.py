@@ -0,0 +1,107 @@
+import os
+import secrets
+
+import streamlit as st
+
+import conversation_store
+import latex_delimiters
+
+# Most recent messages shown on each rerun; older ones load on demand
+# (override with an environment variable)
+WINDOW = int(os.getenv("CHAT_TRANSCRIPT_WINDOW", "40"))
+
+
+def render_message(placeholder, content, display_mode="Markdown", converted=None):
+    # converted: content with its LaTeX delimiters already converted, e.g. by a StreamingConverter
+    if display_mode == "Markdown":
+        placeholder.markdown(converted if converted is not None else latex_delimiters.convert(content))
+    else:
+        placeholder.text(content)
+
+
+def _show_earlier(state_key):
+    st.session_state[state_key] = st.session_state.get(state_key, WINDOW) + WINDOW
+
+
+def reset(state_key="transcript_shown"):
+    # Back to the default window, e.g. when the chat history is cleared
+    st.session_state.pop(state_key, None)
+
+
+def owner_key(state_key="conversation_owner"):
+    # Secret key of this session's conversations: only its holder can list or
+    # resume them, so in a shared deployment no one sees another user's chats
+    if state_key not in st.session_state:
+        st.session_state[state_key] = secrets.token_urlsafe(16)
+    return st.session_state[state_key]
+
+
+def current_conversation(app, state_key="conversation"):
+    # This session's conversation; a fresh page load resumes ?conversation=<id>
+    # if it is this session's, else starts a new one and remembers the id
+    # so use_owner_key() can resume it
+    if state_key not in st.session_state:
+        requested = st.query_params.get("conversation")
+        conversation = conversation_store.open_or_create(app, owner_key(), requested)
+        if requested and conversation.id != requested:
+            st.session_state[f"{state_key}_requested"] = requested
+        st.session_state[state_key] = conversation
+        st.query_params["conversation"] = conversation.id
+    return st.session_state[state_key]
+
+
+def switch_conversation(app, conversation_id=None, state_key="conversation"):
+    # Resume conversation_id (if it is this session's), or start a new conversation
+    conversation = conversation_store.open_or_create(app, owner_key(), conversation_id)
+    st.session_state[state_key] = conversation
+    st.query_params["conversation"] = conversation.id
+    reset()
+    return conversation
+
+
+def use_owner_key(app, state_key="conversation"):
+    # Adopt an owner key from an earlier session (e.g. before a reload) and
+    # resume the conversation that page load asked for
+    key = st.session_state.get(f"{state_key}_owner_input", "").strip()
+    if not key:
+        return
+    st.session_state["conversation_owner"] = key
+    st.session_state[f"{state_key}_owner_input"] = ""
+    requested = st.session_state.pop(f"{state_key}_requested", None)
+    if requested:
+        switch_conversation(app, requested, state_key)
+
+
+def conversation_picker(app, state_key="conversation"):
+    # Sidebar list of this session's recent conversations to resume, plus
+    # resume by id and the owner key to keep them across reloads
+    conversation = current_conversation(app, state_key)
+    with st.sidebar.expander("Conversations"):
+        st.caption(f"Current: `{conversation.id}`")
+        for entry in conversation_store.recent(owner_key(), app, limit=10):
+            if entry["id"] != conversation.id:
+                st.button(f"{entry['title'] or entry['id']} ({entry['messages']} messages)", key=f"resume_{entry['id']}",
+                          on_click=switch_conversation, args=(app, entry["id"], state_key))
+        conversation_id = st.text_input("Resume by id", key=f"{state_key}_resume_id").strip()
+        if conversation_id and conversation_id != conversation.id:
+            st.button("Resume", on_click=switch_conversation, args=(app, conversation_id, state_key))
+        st.caption(f"Owner key: `{owner_key()}`. Keep it to get these conversations back after a reload.")
+        st.text_input("Use owner key", type="password", key=f"{state_key}_owner_input")
+        st.button("Use key", on_click=use_owner_key, args=(app, state_key))
+    return conversation
+
+
+@st.fragment
+def render(messages, display_mode="Markdown", state_key="transcript_shown"):
+    # Renders the last WINDOW messages (more after each "Show earlier" click),
+    # so a rerun costs the same in a 500-turn chat as in a fresh one. This is a
+    # fragment: loading earlier messages reruns only the transcript, not the
+    # page. Markdown conversion is memoized per message in latex_delimiters
+    shown = st.session_state.get(state_key, WINDOW)
+    hidden = max(0, len(messages) - shown)
+    if hidden:
+        st.button(f"Show {min(hidden, WINDOW)} earlier messages ({hidden} hidden)", key=f"{state_key}_earlier",
+                  on_click=_show_earlier, args=(state_key,))
+    for message in messages[hidden:]:
+        with st.chat_message(message["role"]):
+            render_message(st, message["content"], display_mode)
@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import atexit
+import contextvars
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+import numpy as np
+from dotenv import load_dotenv
+
+import model_catalog
+import openrouter_client
+import pricing_engine
+import prompt_caching
+
+logger = logging.getLogger(__name__)
+
+# Ledger settings (override with environment variables)
+LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", ".usage_ledger.sqlite")  # Empty string disables the ledger
+DEFAULT_USER = os.getenv("USAGE_LEDGER_USER")
+RECONCILE_CONCURRENCY = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    day TEXT NOT NULL,
+    generation_id TEXT,
+    model TEXT NOT NULL,
+    provider TEXT,
+    app TEXT,
+    session TEXT,
+    user TEXT,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    cache_write_tokens INTEGER NOT NULL DEFAULT 0,
+    computed_cost REAL,
+    billed_cost REAL,
+    latency REAL
+);
+CREATE INDEX IF NOT EXISTS usage_model_day ON usage (model, day);
+CREATE INDEX IF NOT EXISTS usage_day ON usage (day);
+CREATE INDEX IF NOT EXISTS usage_user_day ON usage (user, day);
+CREATE INDEX IF NOT EXISTS usage_generation ON usage (generation_id);
+CREATE TABLE IF NOT EXISTS generation_costs (
+    generation_id TEXT PRIMARY KEY,
+    total_cost REAL NOT NULL,
+    fetched REAL NOT NULL
+);
+"""
+
+# Columns spend() can group by
+GROUPS = {
+    "model": "u.model",
+    "day": "u.day",
+    "user": "u.user",
+    "session": "u.session",
+    "app": "u.app",
+    "provider": "u.provider",
+}
+
+# Who a request is billed to; set per Streamlit session or per script run
+session_var = contextvars.ContextVar("usage_ledger_session", default=None)
+user_var = contextvars.ContextVar("usage_ledger_user", default=DEFAULT_USER)
+
+_lock = threading.Lock()
+_queue = queue.SimpleQueue()
+_writer = None
+_catalog = None
+
+
+def set_context(session=None, user=None):
+    # Tag the requests made from the current thread (and the client tasks it starts)
+    if session is not None:
+        session_var.set(session)
+    if user is not None:
+        user_var.set(user)
+
+
+def use_catalog(catalog):
+    # Price entries with this catalog instead of the bundled models.json
+    global _catalog
+    _catalog = catalog
+
+
+def connect(path=LEDGER_PATH):
+    db = sqlite3.connect(path, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    if "cache_write_tokens" not in {row[1] for row in db.execute("PRAGMA table_info(usage)")}:
+        # Ledgers created before cache writes were recorded
+        db.execute("ALTER TABLE usage ADD COLUMN cache_write_tokens INTEGER NOT NULL DEFAULT 0")
+    return db
+
+
+def record(model, usage, generation_id=None, provider=None, latency=None, app=None):
+    # Queue one billed request. Never blocks on disk: the writer thread
+    # prices and inserts entries in batches
+    if not LEDGER_PATH or not usage:
+        return
+    _queue.put((time.time(), model, dict(usage), generation_id, provider, latency, app, session_var.get(), user_var.get()))
+    _start_writer()
+
+
+def _start_writer():
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_entries, name="usage-ledger", daemon=True)
+                _writer.start()
+
+
+def _pricing():
+    if _catalog is None:
+        use_catalog(model_catalog.load_catalog_file())
+    return pricing_engine.for_catalog(_catalog)
+
+
+def _rows(entries):
+    # Insert rows for a batch of queued entries, priced in one vectorized pass
+    usages = [entry[2] for entry in entries]
+    prompt_costs, completion_costs = _pricing().costs(
+        [entry[1] for entry in entries],
+        [usage.get('prompt_tokens', 0) for usage in usages],
+        [usage.get('completion_tokens', 0) for usage in usages],
+        [prompt_caching.cached_tokens(usage) for usage in usages],
+        [prompt_caching.cache_write_tokens(usage) for usage in usages],
+        requests=1,  # Each entry is one billed request
+    )
+    rows = []
+    for entry, total in zip(entries, (prompt_costs + completion_costs).tolist()):
+        created, model, usage, generation_id, provider, latency, app, session, user = entry
+        rows.append((
+            created, datetime.fromtimestamp(created, timezone.utc).strftime("%Y-%m-%d"), generation_id, model, provider, app,
+            session, user, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), prompt_caching.cached_tokens(usage),
+            prompt_caching.cache_write_tokens(usage),
+            None if total != total else total,  # NaN: model not in the catalog
+            usage.get('cost'),  # Present when OpenRouter usage accounting is enabled
+            latency,
+        ))
+    return rows
+
+
+def _write_entries():
+    db = None
+    while True:
+        items = [_queue.get()]
+        while True:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        entries = [item for item in items if not isinstance(item, threading.Event)]
+        if entries:
+            try:
+                db = db or connect()
+                with db:
+                    db.executemany(
+                        "INSERT INTO usage (time, day, generation_id, model, provider, app, session, user, prompt_tokens, "
+                        "completion_tokens, cached_tokens, cache_write_tokens, computed_cost, billed_cost, latency) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        _rows(entries),
+                    )
+            except Exception:
+                # Drop this batch (database error, malformed usage) rather than stall or kill the writer
+                logger.exception("Dropped %d usage ledger entries", len(entries))
+                db = None
+        for item in items:
+            if isinstance(item, threading.Event):
+                item.set()
+
+
+@atexit.register
+def flush(timeout=5):
+    # Wait until everything queued so far is written, so short scripts don't lose entries
+    if _writer is None:
+        return
+    written = threading.Event()
+    _queue.put(written)
+    written.wait(timeout)
+
+
+def spend(group_by=("model",), since=None, until=None, path=LEDGER_PATH):
+    # Requests, tokens and spend per group. since/until are "YYYY-MM-DD" days
+    # (until inclusive). billed uses reconciled costs where known
+    columns = [GROUPS[group] for group in group_by]
+    where = []
+    args = []
+    if since:
+        where.append("u.day >= ?")
+        args.append(since)
+    if until:
+        where.append("u.day <= ?")
+        args.append(until)
+    query = (
+        f"SELECT {', '.join(columns + [''])}"
+        "COUNT(*), SUM(u.prompt_tokens), SUM(u.completion_tokens), SUM(u.computed_cost), "
+        "SUM(COALESCE(g.total_cost, u.billed_cost)), COUNT(COALESCE(g.total_cost, u.billed_cost)) "
+        "FROM usage u LEFT JOIN generation_costs g ON g.generation_id = u.generation_id"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + (f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}" if columns else "")
+    )
+    db = connect(path)
+    try:
+        rows = db.execute(query, args).fetchall()
+    finally:
+        db.close()
+    keys = list(group_by) + ["requests", "prompt_tokens", "completion_tokens", "computed_cost", "billed_cost", "billed_requests"]
+    return [dict(zip(keys, row)) for row in rows if row[len(columns)]]
+
+
+def workload(since=None, until=None, models=None, path=LEDGER_PATH):
+    # Token columns of the recorded requests as NumPy arrays, for bulk repricing
+    where = ["1"]
+    args = []
+    if since:
+        where.append("day >= ?")
+        args.append(since)
+    if until:
+        where.append("day <= ?")
+        args.append(until)
+    if models:
+        where.append(f"model IN ({', '.join('?' * len(models))})")
+        args.extend(models)
+    db = connect(path)
+    try:
+        rows = db.execute("SELECT model, prompt_tokens, completion_tokens, cached_tokens, cache_write_tokens "
+                          f"FROM usage WHERE {' AND '.join(where)}", args).fetchall()
+    finally:
+        db.close()
+    if not rows:
+        return None
+    model_ids, prompt_tokens, completion_tokens, cached_tokens, cache_write_tokens = zip(*rows)
+    return {
+        "model": np.array(model_ids, dtype=object),
+        "prompt_tokens": np.array(prompt_tokens, dtype=np.int64),
+        "completion_tokens": np.array(completion_tokens, dtype=np.int64),
+        "cached_tokens": np.array(cached_tokens, dtype=np.int64),
+        "cache_write_tokens": np.array(cache_write_tokens, dtype=np.int64),
+    }
+
+
+def unreconciled(limit=None, path=LEDGER_PATH):
+    db = connect(path)
+    try:
+        query = ("SELECT DISTINCT u.generation_id FROM usage u LEFT JOIN generation_costs g ON g.generation_id = u.generation_id "
+                 "WHERE u.generation_id IS NOT NULL AND u.billed_cost IS NULL AND g.generation_id IS NULL")
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return [row[0] for row in db.execute(query)]
+    finally:
+        db.close()
+
+
+async def _fetch_generation_costs(generation_ids, api_key, concurrency):
+    session = await openrouter_client.get_async_session()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = openrouter_client.build_headers(api_key)
+
+    async def fetch(generation_id):
+        async with semaphore:
+            try:
+                async with session.get(f"{openrouter_client.OPENROUTER_BASE_URL}/generation", params={"id": generation_id},
+                                       headers=headers) as response:
+                    if response.status != 200:
+                        return None  # Usually not available yet; picked up by a later run
+                    body = await response.json()
+                data = body.get('data') if isinstance(body, dict) else None
+                if not isinstance(data, dict) or data.get('total_cost') is None:
+                    return None
+                return generation_id, float(data['total_cost'])
+            except (asyncio.TimeoutError, aiohttp.ClientError, OSError, TypeError, ValueError):
+                # Non-JSON or truncated bodies included: one bad generation mustn't lose the others
+                return None
+
+    results = await asyncio.gather(*[fetch(generation_id) for generation_id in generation_ids])
+    return [result for result in results if result is not None]
+
+
+def reconcile(api_key, limit=None, concurrency=RECONCILE_CONCURRENCY, path=LEDGER_PATH):
+    # Fetch OpenRouter's billed cost for every generation that doesn't have one yet.
+    # Returns (checked, reconciled)
+    generation_ids = unreconciled(limit, path)
+    if not generation_ids:
+        return 0, 0
+    costs = openrouter_client.run(_fetch_generation_costs(generation_ids, api_key, concurrency))
+    db = connect(path)
+    try:
+        with db:
+            db.executemany("INSERT OR REPLACE INTO generation_costs (generation_id, total_cost, fetched) VALUES (?, ?, ?)",
+                           [(generation_id, cost, time.time()) for generation_id, cost in costs])
+    finally:
+        db.close()
+    return len(generation_ids), len(costs)
+
+
+def _money(value):
+    return f"${value:.6f}" if value is not None else "-"
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Report and reconcile the OpenRouter usage ledger")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    report = subcommands.add_parser("report", help="Spend grouped by model, day, user, ...")
+    report.add_argument("--by", nargs="+", choices=list(GROUPS), default=["model"])
+    report.add_argument("--since", metavar="YYYY-MM-DD")
+    report.add_argument("--until", metavar="YYYY-MM-DD")
+    reprice_parser = subcommands.add_parser("reprice", help="What the recorded workload would cost on other models")
+    reprice_parser.add_argument("--since", metavar="YYYY-MM-DD")
+    reprice_parser.add_argument("--until", metavar="YYYY-MM-DD")
+    reprice_parser.add_argument("--from-model", nargs="+", help="Only reprice requests made with these models")
+    reprice_parser.add_argument("--to-model", nargs="+", help="Candidate models (default: the whole catalog)")
+    reprice_parser.add_argument("--top", type=int, default=20, help="Cheapest candidates to show")
+    reconcile_parser = subcommands.add_parser("reconcile", help="Fetch billed costs for unreconciled generations")
+    reconcile_parser.add_argument("--limit", type=int, help="Generations to check in this run")
+    reconcile_parser.add_argument("--concurrency", type=int, default=RECONCILE_CONCURRENCY)
+    args = parser.parse_args()
+
+    if args.command == "reconcile":
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            print("Please set the OPENROUTER_API_KEY environment variable")
+            return
+        checked, reconciled = reconcile(api_key, args.limit, max(1, args.concurrency))
+        print(f"Checked {checked} generations, reconciled {reconciled}")
+        return
+
+    if args.command == "reprice":
+        rows = workload(args.since, args.until, args.from_model)
+        if rows is None:
+            print("No usage recorded for this period")
+            return
+        engine = _pricing()
+        prompt_costs, completion_costs = engine.costs(rows["model"], rows["prompt_tokens"], rows["completion_tokens"],
+                                                      rows["cached_tokens"], rows["cache_write_tokens"], requests=1)
+        print(f"Workload: {len(rows['model'])} requests, tokens: prompt: {rows['prompt_tokens'].sum()}, "
+              f"completion: {rows['completion_tokens'].sum()}, cost at current prices: {_money(np.nansum(prompt_costs + completion_costs))}")
+        candidates = engine.reprice(rows["prompt_tokens"], rows["completion_tokens"], rows["cached_tokens"], rows["cache_write_tokens"],
+                                    models=args.to_model)
+        for model, cost in candidates[:args.top if not args.to_model else None]:
+            print(f"{model}: {_money(cost)}")
+        return
+
+    rows = spend(args.by, args.since, args.until)
+    for row in rows:
+        group = ", ".join(str(row[group]) for group in args.by)
+        print(f"{group}: requests: {row['requests']}, tokens: prompt: {row['prompt_tokens']}, completion: {row['completion_tokens']}, "
+              f"cost: computed: {_money(row['computed_cost'])}, billed: {_money(row['billed_cost'])} "
+              f"({row['billed_requests']}/{row['requests']} reconciled)")
+    if not rows:
+        print("No usage recorded for this period")
+
+
+if __name__ == "__main__":
+    main()